@@ -0,0 +1,315 @@
+"""
+Benchmark
+===
+Times the hot paths of the pipeline on synthetic Home Depot-shaped data, so no Kaggle data or spaCy model is needed.
+---
+Data Science Assignment 3 - Home Depot Search Results
+"""
+
+# python standard library ------------------------------------------------------------------
+import argparse                                             # specifying args from command line |
+import json                                                 # baseline                          |
+import os, sys, time                                        # directories, timing               |
+from collections.abc import Callable                        # timing stages                     |
+# dependencies -----------------------------------------------------------------------------
+import numpy as np                                          # arrays                            |
+import pandas as pd                                         # dataframes                        |
+import spacy                                                # natural language processing       |
+import matplotlib.pyplot as plt                             # scaling curves                    |
+# local imports ----------------------------------------------------------------------------
+from helper import BOLD, PATH, suppress_W008, fix_dirs      # general utilities                 |
+from datamanager import (load_dataframes, input_hash,       # data management                   |
+                         create, store_doc_arrays,          # ...                               |
+                         open_feature_store, store_feature, # ...                               |
+                         PRODUCT_COLUMNS)                   # ...                               |
+from processing import (parse_data, index_products,         # processing data                   |
+                        compute_features,                   # ...                               |
+                        token_vector_table, filter_mask)    # ...                               |
+from plot import (summarize_similarities,                   # summarizing                       |
+                  calc_avg_similarities)                    # ...                               |
+from model import train_and_test, FILTERED_COLUMNS          # regression model                  |
+# ------------------------------------------------------------------------------------------
+
+S_SUFF = '_bench'           # the synthetic data, stored data and results get their own directories
+RELEVANCIES = [1.0, 1.33, 1.67, 2.0, 2.33, 2.67, 3.0]
+# the timed score calculations of every product column, with the metrics they calculate (see `compute_features()`)
+SCORES = [('semantic similarity', ('sem',)), ('simple similarity', ('sim',)),
+          ('sparse similarities', ('tfidf', 'bm25')), ('token similarity', ('tok',))]
+
+@spacy.Language.component('bench_lemmatizer')
+def bench_lemmatizer(doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
+    """Stands in for a trained lemmatizer: lower cases every token and strips a plural s"""
+    for token in doc:
+        token.lemma_ = token.lower_.rstrip('s') or token.lower_
+    return doc
+
+def make_pipeline(vocabulary: list[str], width: int = 300, seed: int = 0) -> spacy.Language:
+    """Creates a blank English pipeline with a lemmatizer stand-in and random word vectors for the given words"""
+    nlp: spacy.Language = spacy.blank('en')
+    nlp.add_pipe('bench_lemmatizer', name='lemmatizer')
+    rng = np.random.default_rng(seed)
+    for word in vocabulary:
+        nlp.vocab.set_vector(word, rng.normal(size=width).astype(np.float32))
+    return nlp
+
+def make_vocabulary(size: int = 5000, seed: int = 0) -> list[str]:
+    """Creates random lower case words of 3 to 9 letters (half of them with a plural variant)"""
+    rng = np.random.default_rng(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    words: set[str] = set()
+    while len(words) < size:
+        words.add(''.join(rng.choice(letters, rng.integers(3, 10))))
+    words: list[str] = sorted(words)
+    return words + [word+'s' for word in words[::2]]
+
+def generate_data(n_rows: int, n_products: int, description_length: int, vocabulary: list[str],
+                  seed: int = 0) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Generates synthetic train & product_descriptions data with the same columns as the Kaggle data.
+    Words are drawn from a Zipf-like distribution, product titles and search terms share words with
+    their product's description, and rows of the same product are next to each other (as in train).
+    ### params
+        - n_rows: the amount of rows of train
+        - n_products: the amount of unique products (at most n_rows are used)
+        - description_length: the average amount of words of a product description
+        - vocabulary: the words that are drawn from
+        - seed: seed of the random number generator
+
+    ### returns
+        - train: a `DataFrame` with id, product_uid, product_title, search_term and relevance columns
+        - product_descriptions: a `DataFrame` with product_uid and product_description columns
+    """
+    rng = np.random.default_rng(seed)
+    words = np.array(vocabulary)
+    p: np.ndarray = 1 / np.arange(1, len(words)+1)
+    p /= p.sum()
+
+    product_uids = np.arange(100_001, 100_001 + n_products)
+    descriptions: list[np.ndarray] = [rng.choice(words, max(int(rng.normal(description_length, description_length/4)),
+                                                            5), p=p) for _ in product_uids]
+    titles: list[str] = [' '.join(rng.choice(description, rng.integers(3, 12))) for description in descriptions]
+
+    rows: np.ndarray = np.sort(np.concatenate([np.arange(min(n_products, n_rows)),      # every product is used
+                                               rng.integers(0, n_products, max(n_rows - n_products, 0))]))
+    search_terms: list[str] = [' '.join(np.concatenate([rng.choice(descriptions[row], rng.integers(0, 3)),
+                                                        rng.choice(words, rng.integers(1, 3), p=p)]))
+                               for row in rows]
+    train = pd.DataFrame({'id': np.arange(1, n_rows+1), 'product_uid': product_uids[rows],
+                          'product_title': [titles[row] for row in rows], 'search_term': search_terms,
+                          'relevance': rng.choice(RELEVANCIES, n_rows)})
+    product_descriptions = pd.DataFrame({'product_uid': product_uids,
+                                         'product_description': [' '.join(description) for description in descriptions]})
+    return train, product_descriptions
+
+def write_data(train: pd.DataFrame, product_descriptions: pd.DataFrame) -> None:
+    """Writes synthetic data to the benchmark data directory as csv files, like the Kaggle data"""
+    data_dir: str = PATH('..',f'data{S_SUFF}')
+    os.makedirs(data_dir, exist_ok=True)
+    train.to_csv(os.path.join(data_dir, 'train.csv'), index=False, encoding='ISO-8859-1')
+    product_descriptions.to_csv(os.path.join(data_dir, 'product_descriptions.csv'), index=False, encoding='ISO-8859-1')
+
+def run_stages(nlp: spacy.Language) -> dict[str, float]:
+    """
+    Runs every benchmarked stage once on the synthetic data in the benchmark data directory,
+    in the same order (and with the same functions) as main.py runs them.
+    ### params
+        - nlp: the spaCy `Language` object used to parse the strings
+
+    ### returns
+        - the amount of seconds every stage took
+    """
+    times: dict[str, float] = {}
+    def timed(stage: str, function: Callable, *args, **kwargs):
+        start: float = time.perf_counter()
+        result = function(*args, **kwargs)
+        times[stage] = time.perf_counter() - start
+        return result
+
+    datasets = ['train', 'product_descriptions']
+    timed('hashing csv files', input_hash, datasets, S_SUFF)
+    df_train, df_prod_desc = timed('reading csv files', load_dataframes, datasets, S_SUFF)
+    dataframe = pd.merge(df_train, df_prod_desc, how='left', on='product_uid')
+    product_index, first_rows = index_products(dataframe['product_uid'])
+
+    create('docdata')
+    create('arrays')
+    doc_arrays = {'search_term': timed('parsing search_term', parse_data, dataframe['search_term'], nlp)[1]}
+    for col in PRODUCT_COLUMNS:
+        doc_arrays[col] = timed(f'parsing {col}', parse_data, dataframe[col].iloc[first_rows], nlp)[1]
+    for col, arrays in doc_arrays.items():
+        timed(f'storing {col} doc arrays', store_doc_arrays, arrays, col,
+              nlp.pipe_names, nlp.component_names)
+    tables = {col: timed(f'building {col} token vector table', token_vector_table, nlp, arrays.orths)
+              for col, arrays in doc_arrays.items()}
+
+    open_feature_store(dataframe['id'].values, dataframe['relevance'].values)
+    features = pd.DataFrame({'relevance': dataframe['relevance'].values, 'row_id': dataframe['id'].values})
+    score = lambda products, metrics: compute_features(doc_arrays['search_term'], products, product_index, metrics,
+                                                       tables=tables)
+    features['len_of_query'] = timed('calculating query length', score, {}, ('len',))['len_of_query']
+    for col in PRODUCT_COLUMNS:
+        for stage, metrics in SCORES:
+            for metric, values in timed(f'{stage} {col}', score, {col: doc_arrays[col]}, metrics).items():
+                features[metric] = values
+    timed('storing features', lambda: [store_feature(features[col].values, col) for col in features.columns[2:]])
+
+    def summarize():
+        for metric in features.columns[3:]:
+            calc_avg_similarities(features, metric, summarize_similarities(features, metric))
+    timed('averaging similarities', summarize)
+
+    keep, _ = filter_mask(features, FILTERED_COLUMNS)
+    timed('training and testing', train_and_test, features, keep, n_jobs=1)
+    timed('training and testing (boosting)', train_and_test, features, keep, n_jobs=1, engine='boosting')
+    return times
+
+def benchmark(scales: list[int], rows_per_product: float, description_length: int,
+              repeat: int) -> pd.DataFrame:
+    """
+    Times every stage at every scale, the fastest of `repeat` runs is kept (the least disturbed by other processes).
+    ### params
+        - scales: the amounts of rows of train to generate
+        - rows_per_product: the average amount of rows per unique product
+        - description_length: the average amount of words of a product description
+        - repeat: the amount of times every scale is run
+
+    ### returns
+        - a `DataFrame` with a row per stage and a column per scale, in seconds
+    """
+    vocabulary: list[str] = make_vocabulary()
+    nlp: spacy.Language = make_pipeline(vocabulary)
+    results: dict[int, dict[str, float]] = {}
+    for n_rows in scales:
+        print(f'generating {BOLD(n_rows)} rows', end='', flush=True)
+        write_data(*generate_data(n_rows, max(int(n_rows / rows_per_product), 1), description_length, vocabulary))
+        runs: list[dict[str, float]] = []
+        for _ in range(repeat):
+            print('.', end='', flush=True)
+            runs.append(run_stages(nlp))
+        results[n_rows] = {stage: min(run[stage] for run in runs) for stage in runs[0]}
+        print(f' {sum(results[n_rows].values()):.2f} s')
+    return pd.DataFrame(results)
+
+def scaling_exponents(times: pd.DataFrame) -> pd.Series:
+    """
+    Fits time ~ rows^exponent on every stage (a line in log-log space),
+    an exponent of 1 means that a stage scales linearly with the amount of rows
+    """
+    log_rows: np.ndarray = np.log(times.columns.values.astype(float))
+    return times.apply(lambda stage: np.polyfit(log_rows, np.log(np.maximum(stage.values, 1e-6)), 1)[0]
+                       if len(log_rows) > 1 else np.nan, axis=1)
+
+def plot_scaling_curves(times: pd.DataFrame) -> None:
+    """Plots the time of every stage against the amount of rows (on log-log axes) and saves it to disk"""
+    fig, ax = plt.subplots(figsize=(8, 6))
+    for stage, stage_times in times.iterrows():
+        ax.plot(times.columns, stage_times.values, marker='o', label=stage)
+    ax.set_xscale('log')
+    ax.set_yscale('log')
+    ax.set_xlabel('rows')
+    ax.set_ylabel('seconds')
+    ax.set_title('Scaling Curves')
+    ax.legend(fontsize='small', bbox_to_anchor=(1.02, 1), loc='upper left')
+    fig.savefig(PATH('..',f'results{S_SUFF}','scaling_curves.png'), bbox_inches='tight', dpi=300)
+    plt.close(fig)
+
+def compare_to_baseline(times: pd.DataFrame, baseline: dict[str, dict[str, float]], threshold: float,
+                        min_time: float) -> list[str]:
+    """
+    Compares the times of every stage and scale to a stored baseline.
+    ### params
+        - times: the output of `benchmark()`
+        - baseline: earlier times, by stage and then by scale
+        - threshold: the share a stage can be slower than the baseline before it counts as a regression (0.25 = 25%)
+        - min_time: stages that take less than this many seconds in both runs are ignored, as their times are noise
+
+    ### returns
+        - a description of every regression
+    """
+    regressions: list[str] = []
+    for stage, stage_times in times.iterrows():
+        for n_rows, seconds in stage_times.items():
+            before: float = baseline.get(stage, {}).get(str(n_rows))
+            if before is None or max(before, seconds) < min_time:
+                continue
+            if seconds > before * (1 + threshold):
+                regressions.append(f'{stage} @ {n_rows} rows: {before:.3f} s -> {seconds:.3f} s '
+                                   f'(+{100 * (seconds/before - 1):.0f}%)')
+    return regressions
+
+def argparse_wrapper(parser: argparse.ArgumentParser) -> tuple[list[int], float, int, int, str, bool, float, float]:
+    """
+    Returns the parsed arguments of the benchmark.
+    ### params
+        - the argparse `ArgumentParser` object that was instantiated in benchmark.py
+
+    ### returns
+        - scales: the amounts of rows of train that are benchmarked
+        - rows_per_product: the average amount of rows per unique product
+        - description_length: the average amount of words of a product description
+        - repeat: the amount of times every scale is run
+        - baseline: location of the baseline file
+        - save_baseline: toggles storing the times as the new baseline instead of comparing to it
+        - threshold: the share a stage can be slower than the baseline before the benchmark fails
+        - min_time: stages that take less than this many seconds are not compared to the baseline
+    """
+    parser.add_argument('--scales', type=lambda arg: [int(n) for n in arg.split(',')], default=[1000, 4000, 16000],
+                        help='comma separated amounts of rows of train to benchmark, default is 1000,4000,16000')
+    parser.add_argument('--rows_per_product', type=float, default=1.35,
+                        help='average amount of rows per unique product (about 1.35 in the Kaggle data)')
+    parser.add_argument('--description_length', type=int, default=140,
+                        help='average amount of words of a product description (about 140 in the Kaggle data)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='amount of times every scale is run, the fastest run is kept')
+    parser.add_argument('--baseline', type=str, default=None,
+                        help=f'baseline file, default is results{S_SUFF}/baseline.json')
+    parser.add_argument('--save_baseline', action='store_true',
+                        help='store the times as the new baseline instead of comparing to the current one')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='fail if a stage is more than this share slower than the baseline (0.25 = 25%%)')
+    parser.add_argument('--min_time', type=float, default=0.05,
+                        help='stages that take less seconds than this are not compared to the baseline')
+
+    args = parser.parse_args()
+    baseline = os.path.abspath(args.baseline) if args.baseline else None   # the working directory is changed later on
+    return args.scales, args.rows_per_product, args.description_length, args.repeat, baseline, args.save_baseline, \
+           args.threshold, args.min_time
+
+def main():
+
+    scales, rows_per_product, description_length, repeat, baseline_file, save_baseline, threshold, min_time = \
+        argparse_wrapper(argparse.ArgumentParser())
+    suppress_W008()
+    fix_dirs(S_SUFF)
+    baseline_file = baseline_file or PATH('..',f'results{S_SUFF}','baseline.json')
+
+    times: pd.DataFrame = benchmark(sorted(scales), rows_per_product, description_length, repeat)
+    report: pd.DataFrame = times.copy()
+    report['exponent'] = scaling_exponents(times)
+    report.to_csv(PATH('..',f'results{S_SUFF}','benchmark.csv'), index_label='stage')
+    plot_scaling_curves(times)
+    print('\nseconds per stage (and scaling exponent, 1 = linear):')
+    print(report.to_string(float_format='{:.3f}'.format))
+
+    if save_baseline:
+        with open(baseline_file, 'w') as f:
+            json.dump({stage: {str(n_rows): seconds for n_rows, seconds in stage_times.items()}
+                       for stage, stage_times in times.iterrows()}, f, indent=2)
+        print(f'\nbaseline saved to {BOLD(baseline_file)}')
+        return
+    if not os.path.exists(baseline_file):
+        print(f'\nno baseline to compare to, store one with {BOLD("--save_baseline")}')
+        return
+
+    with open(baseline_file) as f:
+        regressions: list[str] = compare_to_baseline(times, json.load(f), threshold, min_time)
+    if regressions:
+        print(f'\nERROR: {len(regressions)} stage(s) regressed more than {threshold:.0%} compared to the baseline:')
+        for regression in regressions:
+            print('*', regression)
+        sys.exit(1)
+    print(f'\nno stage regressed more than {threshold:.0%} compared to the baseline')
+
+
+if __name__ == "__main__":
+    main()
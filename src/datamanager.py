@@ -6,15 +6,38 @@ Functions pertaining to data loading and parsing.
 Data Science Assignment 3 - Home Depot Search Results
 """
 
-# python standard library ----------------------------------------
-import os, sys, shutil              # directories                 |
-# dependencies ---------------------------------------------------
-import pandas as pd                 # dataframes                  |
-import spacy                        # natural language processing |
-import numpy as np                  # arrays                      |
-# local imports --------------------------------------------------
-from helper import BOLD, PATH       # TUI, directories            |
-# ----------------------------------------------------------------
+from __future__ import annotations  # spaCy & joblib are only imported when they are used
+# python standard library ---------------------------------------------------------------
+import os, sys                                        # directories                     |
+import json                                           # docbin metadata, manifest       |
+import hashlib                                        # artifact keys                   |
+import csv, io, struct                                # streaming ingestion             |
+import sqlite3, time                                  # persistent query cache          |
+from collections.abc import Iterator, Callable        # streaming ingestion, keys       |
+from importlib.metadata import version                # artifact keys                   |
+from typing import TYPE_CHECKING                      # type hints of lazy imports      |
+# dependencies --------------------------------------------------------------------------
+import pandas as pd                                   # dataframes                      |
+import numpy as np                                    # arrays                          |
+if TYPE_CHECKING:
+    import spacy                                      # natural language processing     |
+# local imports -------------------------------------------------------------------------
+from helper import BOLD, PATH                         # TUI, directories                |
+from processing import (FEATURES, DocArrays,          # docbin metadata, doc arrays     |
+                        TokenVectors,                 # token vector tables             |
+                        required_components,          # ...                             |
+                        FEATURE_COMPONENTS,           # ...                             |
+                        FEATURE_VERSION,              # artifact keys                   |
+                        MIN_SIMILARITY,               # ...                             |
+                        MIN_RELEVANCE_SHARE)          # ...                             |
+# ---------------------------------------------------------------------------------------
+
+PRODUCT_COLUMNS = ('product_title', 'product_description')     # stored once per unique product
+SIMILARITY_KINDS = ('sem', 'sim', 'tfidf', 'bm25', 'tok')    # semantic, simple (hits), TF-IDF, BM25 & token-level
+METRIC_COLUMNS = {'len_of_query': 'search_term'} | {f'{sim_kind}_sim_{col}': col for col in PRODUCT_COLUMNS
+                                                                                for sim_kind in SIMILARITY_KINDS}
+FEATURE_COLUMNS = tuple(METRIC_COLUMNS)                         # columns of the feature store
+MODEL_VERSION = 2                   # bump whenever a change in model.py alters the stored models or their inputs
 
 def load_dataframes(filenames: list[str], s_suff: str) -> list[pd.DataFrame]:
     """
@@ -44,50 +67,525 @@ def load_dataframes(filenames: list[str], s_suff: str) -> list[pd.DataFrame]:
     
     return dataframes
 
+def load_column(datasets: list[str], s_suff: str, col_name: str) -> pd.Series:
+    """
+    Loads a single column that needs to be parsed, without reading any csv file the column is not in.
+    ### params
+        - datasets: the names of the train and product descriptions csv files
+        - s_suff: determines whether the experiment is run on sample dataset
+        - col_name: the name of the column
+
+    ### returns
+        - the column, with one entry per row of train for search_term, and one per unique product otherwise
+    """
+    train, product_descriptions = datasets
+    dataframe: pd.DataFrame = load_dataframes([train], s_suff)[0]
+    if col_name in PRODUCT_COLUMNS:
+        # every unique product only needs to be parsed once, kept in order of first appearance (see `index_products()`)
+        dataframe = dataframe.drop_duplicates('product_uid')
+    if col_name == 'product_description':
+        dataframe = pd.merge(dataframe[['product_uid']], load_dataframes([product_descriptions], s_suff)[0],
+                             how='left', on='product_uid')
+    return dataframe[col_name]
+
+def stream_dataframe(filename: str, s_suff: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """
+    Reads a csv file in chunks, so that it never has to be fully present in memory.
+    ### params
+        - filename: name of the file to read, path and file extension do not need to be specified
+        - s_suff: determines whether the experiment is run on sample dataset
+        - chunk_size: the amount of rows in every chunk
+    
+    ### yields
+        - the chunks as pandas `DataFrame` objects, without their corrupted entries
+    """
+    global _S
+    _S = s_suff
+    try:
+        reader = pd.read_csv(PATH('..',f'data{_S}',filename+'.csv'), encoding='ISO-8859-1', chunksize=chunk_size)
+    except FileNotFoundError:
+        print(f'Error: No file called {BOLD(filename)} is present in the data directory.')
+        sys.exit(1)
+    with reader:
+        for chunk in reader:
+            yield chunk.dropna()
+
+class ProductLookup:
+
+    def __init__(self, filename: str) -> None:
+        """
+        Indexes where every product's row starts in a csv file (keyed by product_uid, the first column),
+        so that its text can be read from disk on demand instead of keeping the whole file in memory.
+        """
+        self.loc: str = PATH('..',f'data{_S}',filename+'.csv')
+        self.rows: dict[int, tuple[int, int]] = {}      # product_uid -> (byte offset, byte length)
+        with open(self.loc, 'rb') as f:
+            offset: int = len(f.readline())             # skip header
+            record: bytes = b''
+            for line in f:
+                record += line
+                if record.count(b'"') % 2:              # a quoted field continues on the next line
+                    continue
+                uid, text = record.split(b',', 1)
+                if text.strip(b'"\r\n'):                # empty texts count as corrupted entries
+                    self.rows[int(uid)] = (offset, len(record))
+                offset += len(record)
+                record = b''
+        self.file = open(self.loc, 'rb')
+
+    def __contains__(self, uid: int) -> bool:
+        return uid in self.rows
+
+    def __getitem__(self, uid: int) -> str:
+        """Reads the text of the given product from disk"""
+        offset, length = self.rows[uid]
+        self.file.seek(offset)
+        record: str = self.file.read(length).decode('ISO-8859-1')
+        return next(csv.reader(io.StringIO(record)))[1]
+
 def create(dir_name: str) -> None:
-    """Creates a directory in the storage folder"""
-    if os.path.exists(dir := PATH('..','storage'+_S,dir_name)):
-        shutil.rmtree(dir)      # clear old data
-    os.mkdir(dir)               # make fresh directory, also works if no directory was present in the first place
-
-def require(dir_name: str) -> None:
-    """Checks if docbins or arrays directory exists"""
-    if not os.path.exists((dir := PATH('..',f'storage{_S}',dir_name))):
-        print(f'\nERROR: Some data is missing, please verify that all necessary data for the task is',
-                f'present in the storage{_S}/{BOLD(dir)} directory.\n')
+    """Creates a directory in the storage folder, artifacts that are already present in it are kept"""
+    os.makedirs(PATH('..',f'storage{_S}',dir_name), exist_ok=True)
+
+def use_dataset(s_suff: str) -> None:
+    """Lets the data manager know on what dataset the experiment is running (e.g. in a worker process)"""
+    global _S
+    _S = s_suff
+
+def input_hash(filenames: list[str], s_suff: str) -> str:
+    """Hashes the contents of the given csv files, every stored artifact is derived from this hash"""
+    global _S
+    _S = s_suff
+    sha = hashlib.sha256()
+    for filename in filenames:
+        with open(PATH('..',f'data{_S}',filename+'.csv'), 'rb') as f:
+            while chunk := f.read(1 << 20):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def package_versions(*packages: str) -> list[str]:
+    """Looks up the installed versions of the given packages (without importing them)"""
+    return [f'{package}=={version(package)}' for package in packages]
+
+def artifact_key(*parts) -> str:
+    """Combines everything an artifact depends on (input hash, column, versions, options) into a single key"""
+    return hashlib.sha256(json.dumps(parts).encode()).hexdigest()[:16]
+
+def artifact_keys(inputs: str, versions: list[str], full_pipeline: bool,
+                  substring_hits: bool) -> tuple[Callable[[str], str], Callable[[str, str], str], Callable[[str], str]]:
+    """
+    Creates the functions that compute the keys of all stored artifacts,
+    every key is derived from everything its artifact was derived from, so up to date artifacts can be reused.
+    ### params
+        - inputs: the output of `input_hash()`
+        - versions: the output of `package_versions()` for spaCy and its model
+        - full_pipeline: whether all spaCy pipeline components were run while parsing
+        - substring_hits: whether simple similarity hits are counted with substring matching
+    
+    ### returns
+        - parse_key: key of a parsed column (or the product index / product uids), by column name,
+                     '<column>/tokens' gives the key of the column's token vector table
+        - calc_key: key of a calculated metric, by metric name and the name of the product column it was calculated on
+        - model_key: key of the stored regression model, by engine name (see model.py)
+    """
+    def parse_key(col: str) -> str:
+        if col.endswith('/tokens'):     # built from the parsed column and the model's vectors, without parsing again
+            return artifact_key('parse', parse_key(col.removesuffix('/tokens')), 'tokens')
+        return artifact_key('parse', inputs, col, versions, FEATURE_VERSION, full_pipeline)
+    calc_key = lambda metric, col: artifact_key('calc', parse_key('search_term'), parse_key(col), metric,
+                                                FEATURE_VERSION, substring_hits and metric.startswith('sim_sim_'))
+    model_key = lambda engine: artifact_key('model', engine, MODEL_VERSION, MIN_SIMILARITY, MIN_RELEVANCE_SHARE,
+                                            [calc_key(metric, col) for metric, col in METRIC_COLUMNS.items()])
+    return parse_key, calc_key, model_key
+
+def _read_manifest() -> dict:
+    """Reads the manifest of all stored artifacts: {artifact: {'key': key, 'files': {file: size}}}"""
+    try:
+        with open(PATH('..',f'storage{_S}','manifest.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def is_valid(artifact: str, key: str) -> bool:
+    """Checks if an artifact was stored with the given key and if all of its files are still intact"""
+    entry: dict = _read_manifest().get(artifact, {})
+    if entry.get('key') != key:
+        return False
+    files = [PATH('..',f'storage{_S}',file) for file in entry['files']]
+    return all(os.path.exists(file) and os.path.getsize(file) == size for file, size in zip(files, entry['files'].values()))
+
+def register(artifact: str, key: str, files: list[str]) -> None:
+    """Records in the manifest that an artifact, consisting of the given files in the storage folder, was stored"""
+    manifest: dict = _read_manifest()
+    manifest[artifact] = {'key': key, 'files': {file: os.path.getsize(PATH('..',f'storage{_S}',file)) for file in files}}
+    _write_manifest(manifest)
+
+def _write_manifest(manifest: dict) -> None:
+    """Replaces the manifest on disk"""
+    tmp = PATH('..',f'storage{_S}','manifest.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, PATH('..',f'storage{_S}','manifest.json'))     # never leave a half written manifest behind
+
+def invalidate(prefix: str) -> None:
+    """Removes all artifacts whose name starts with the given prefix from the manifest"""
+    manifest: dict = _read_manifest()
+    for artifact in [artifact for artifact in manifest if artifact.startswith(prefix)]:
+        del manifest[artifact]
+    _write_manifest(manifest)
+
+def require(artifact: str, key: str) -> None:
+    """Checks if a valid version of the given artifact is present in the storage folder"""
+    if not is_valid(artifact, key):
+        print(f'\nERROR: Some data is missing or outdated, please verify that {BOLD(artifact)} was created',
+              f'from the current data and settings, and is present in the storage{_S} directory.\n')
         sys.exit(1)
 
-def store_as_docbin(db: spacy.tokens.DocBin, col_name: str) -> None:
+def artifact_size(artifact: str) -> int:
+    """Returns the amount of bytes the stored files of an artifact take up, 0 if it was never stored"""
+    return sum(_read_manifest().get(artifact, {}).get('files', {}).values())
+
+def store_as_docbin(db: spacy.tokens.DocBin, col_name: str, components: list[str]) -> list[str]:
     """
     Stores a spaCy `DocBin` on the user's disk at the specified location in the .spacy file format.
     ### params
         - db: a spaCy `DocBin` that is to be saved
         - col_name: name of the column in that `DataFrame` represented by the given `DocBin`
+        - components: names of the pipeline components that were active while parsing the docs
+
+    ### returns
+        - the stored files, relative to the storage folder
     """
     loc = PATH('..',f'storage{_S}','docbins',f'{col_name}.spacy')
     db.to_disk(loc)	    # store DocBin to disk at specified location
+    from spacy.attrs import IDS
+    attr_names = {attr_id: name for name, attr_id in IDS.items()}
+    meta = {'components': components, 'attrs': [attr_names[attr_id] for attr_id in db.attrs]}
+    with open(PATH('..',f'storage{_S}','docbins',f'{col_name}.json'), 'w') as f:
+        json.dump(meta, f)  # DocBin files have no room for metadata, so it is stored next to it
+    return [f'docbins/{col_name}.spacy', f'docbins/{col_name}.json']
 
-def load_docs(col_name: str, nlp: spacy.Language) -> pd.DataFrame:
+def store_product_index(product_index: np.ndarray) -> list[str]:
+    """Stores the row -> unique product mapping that belongs to the product columns' docs and doc arrays"""
+    loc = PATH('..',f'storage{_S}','docdata','product_index.npy')
+    np.save(loc, product_index)	    # store array to disk at specified location
+    return ['docdata/product_index.npy']
+
+def load_product_index() -> np.ndarray:
+    """Loads the row -> unique product mapping present on the user's disk"""
+    return np.load(PATH('..',f'storage{_S}','docdata','product_index.npy'))
+
+def store_product_uids(product_uids: np.ndarray) -> list[str]:
+    """Stores the product_uid of every unique product, in the order of the product columns' doc arrays"""
+    np.save(PATH('..',f'storage{_S}','docdata','product_uids.npy'), product_uids.astype(np.int64))
+    return ['docdata/product_uids.npy']
+
+def load_product_uids() -> np.ndarray:
+    """Loads the product_uid of every unique product present on the user's disk"""
+    return np.load(PATH('..',f'storage{_S}','docdata','product_uids.npy'))
+
+def store_doc_arrays(doc_arrays: DocArrays, col_name: str, components: list[str],
+                     all_components: list[str]) -> list[str]:
     """
-    For a given column, loads the spaCy `Doc` objects present on the user's disk.
+    Stores the vectors and token IDs of a column's docs on the user's disk in the .npy file format,
+    so that the similarity metrics can be calculated without deserializing the docs (or loading spaCy).
     ### params
-        - col_name: name of the column to be loaded
-        - nlp: the spaCy `Language` object used to parse the strings
-        - s_suff: determines whether the experiment is run on sample dataset
-    
+        - doc_arrays: the `DocArrays` that are to be saved
+        - col_name: name of the column in that `DataFrame` represented by the given `DocArrays`
+        - components: names of the pipeline components that were active while parsing the docs
+        - all_components: names of all components of the pipeline, including the disabled ones
+
     ### returns
-        - the `Doc` data that was present on the disk
+        - the stored files, relative to the storage folder
+    """
+    for field in ['vectors', 'orths', 'lemmas', 'offsets']:
+        np.save(PATH('..',f'storage{_S}','docdata',f'{col_name}_{field}.npy'), getattr(doc_arrays, field))
+    with open(PATH('..',f'storage{_S}','docdata',f'{col_name}_strings.json'), 'w') as f:
+        json.dump(doc_arrays.strings, f)
+    return [f'docdata/{col_name}_{field}' for field in ['vectors.npy', 'orths.npy', 'lemmas.npy', 'offsets.npy', 'strings.json']] \
+           + store_components(col_name, components, all_components)
+
+def store_components(col_name: str, components: list[str], all_components: list[str]) -> list[str]:
+    """Stores the names of the pipeline components a column's docs were parsed with next to its doc arrays"""
+    with open(PATH('..',f'storage{_S}','docdata',f'{col_name}_components.json'), 'w') as f:
+        json.dump({'components': components, 'all_components': all_components}, f)
+    return [f'docdata/{col_name}_components.json']
+
+def missing_components(col_name: str, features: tuple[str, ...] = FEATURES) -> list[str]:
+    """
+    Returns the pipeline components that the given features need, but that the stored docs of a column were parsed without.
+    Data that was stored before the components were recorded next to the doc arrays is checked with the metadata
+    of its `DocBin`, in which case every component that the features can need is required.
+    """
+    meta: dict = {'components': []}
+    for loc in [PATH('..',f'storage{_S}','docdata',f'{col_name}_components.json'),
+                PATH('..',f'storage{_S}','docbins',f'{col_name}.json')]:
+        if os.path.exists(loc):
+            with open(loc) as f:
+                meta = json.load(f)
+            break
+    all_components: list[str] = meta.get('all_components',
+                                         [component for feature in features for component in FEATURE_COMPONENTS[feature]])
+    return [c for c in required_components(features, all_components) if c not in meta['components']]
+
+def check_components(col_name: str, features: tuple[str, ...] = FEATURES) -> None:
+    """
+    Exits if the stored docs of a column were parsed without a pipeline component that the given features need,
+    main.py parses them (and calculates all scores) again on its next run.
+    """
+    if missing := missing_components(col_name, features):
+        print(f'\nERROR: The stored {BOLD(col_name)} docs were parsed without {", ".join(missing)},',
+              f'which is needed for {", ".join(features)}. main.py parses them again on its next run.\n')
+        sys.exit(1)
+
+def store_token_vectors(table: TokenVectors, col_name: str) -> list[str]:
+    """Stores the token vector table of a column (see `processing.token_vector_table()`), returns the stored files"""
+    for field in ['orths', 'vectors']:
+        np.save(PATH('..',f'storage{_S}','docdata',f'{col_name}_token_{field}.npy'), getattr(table, field))
+    return [f'docdata/{col_name}_token_{field}.npy' for field in ['orths', 'vectors']]
+
+def load_token_vectors(col_name: str) -> TokenVectors:
+    """For a given column, opens the token vector table present on the user's disk (memory-mapped)"""
+    return TokenVectors(*[np.load(PATH('..',f'storage{_S}','docdata',f'{col_name}_token_{field}.npy'), mmap_mode='r')
+                          for field in ['orths', 'vectors']])
+
+class ArrayAppender:
+
+    HEADER_SIZE = 128   # bytes reserved for the .npy header, which is only filled in once the final shape is known
+
+    def __init__(self, loc: str, dtype: np.dtype, width: int = None) -> None:
+        """Sets up a .npy file on disk that rows can be appended to without keeping them in memory"""
+        self.loc, self.dtype, self.width = loc, np.dtype(dtype), width
+        self.rows: int = 0
+        self.file = open(loc, 'wb')
+        self.file.write(self._header())
+
+    def _header(self) -> bytes:
+        """Creates a .npy (version 1.0) header for the current shape, padded to the reserved size"""
+        shape = (self.rows,) if self.width is None else (self.rows, self.width)
+        header = repr({'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False, 'shape': shape})
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', self.HEADER_SIZE-10) \
+               + header.encode('latin1').ljust(self.HEADER_SIZE-11) + b'\n'
+
+    def append(self, rows: np.ndarray) -> None:
+        """Writes the given rows to the end of the file"""
+        self.file.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        self.rows += len(rows)
+
+    def view(self) -> np.ndarray:
+        """Memory-maps all rows that have been appended so far"""
+        self.file.flush()
+        shape = (self.rows,) if self.width is None else (self.rows, self.width)
+        if not self.rows:
+            return np.zeros(shape, dtype=self.dtype)
+        return np.memmap(self.loc, dtype=self.dtype, mode='r', offset=self.HEADER_SIZE, shape=shape)
+
+    def close(self) -> None:
+        """Fills in the final shape, after which the file can be read with `np.load`"""
+        self.file.seek(0)
+        self.file.write(self._header())
+        self.file.close()
+
+class DocArraysAppender:
+
+    def __init__(self, col_name: str, width: int, components: list[str], all_components: list[str]) -> None:
+        """
+        Sets up the .npy files of a column's `DocArrays` on disk, so docs can be appended chunk by chunk,
+        the pipeline components are those of `store_doc_arrays()`
+        """
+        self.col_name: str = col_name
+        self.components = components
+        self.all_components = all_components
+        loc = lambda field: PATH('..',f'storage{_S}','docdata',f'{col_name}_{field}.npy')
+        self.vectors = ArrayAppender(loc('vectors'), np.float32, width)
+        self.orths = ArrayAppender(loc('orths'), np.uint64)
+        self.lemmas = ArrayAppender(loc('lemmas'), np.uint64)
+        self.offsets = ArrayAppender(loc('offsets'), np.int64)
+        self.offsets.append(np.zeros(1))
+        self.strings: dict[int, str] = {}
+
+    def append(self, doc_arrays: DocArrays) -> None:
+        """Appends the docs of the given `DocArrays` after the docs that are already stored"""
+        self.vectors.append(doc_arrays.vectors)
+        self.offsets.append(doc_arrays.offsets[1:] + self.orths.rows)
+        self.orths.append(doc_arrays.orths)
+        self.lemmas.append(doc_arrays.lemmas)
+        self.strings.update(doc_arrays.strings)
+
+    def view(self) -> DocArrays:
+        """Memory-maps all docs that have been appended so far"""
+        return DocArrays(self.vectors.view(), self.orths.view(), self.lemmas.view(), self.offsets.view(), self.strings)
+
+    def close(self) -> list[str]:
+        """Finishes all files, returns the stored files relative to the storage folder (like `store_doc_arrays()`)"""
+        for appender in [self.vectors, self.orths, self.lemmas, self.offsets]:
+            appender.close()
+        with open(PATH('..',f'storage{_S}','docdata',f'{self.col_name}_strings.json'), 'w') as f:
+            json.dump(self.strings, f)
+        return [f'docdata/{self.col_name}_{field}' for field in ['vectors.npy', 'orths.npy', 'lemmas.npy', 'offsets.npy', 'strings.json']] \
+               + store_components(self.col_name, self.components, self.all_components)
+
+def load_doc_arrays(col_name: str, features: tuple[str, ...] = FEATURES) -> DocArrays:
+    """
+    For a given column, opens the `DocArrays` present on the user's disk (arrays are memory-mapped).
+    Exits if the docs were parsed without a pipeline component that the given features need (see `check_components()`).
     """
-    db = spacy.tokens.DocBin().from_disk(PATH('..',f'storage{_S}','docbins',f'{col_name}.spacy'))
-    docs = list(db.get_docs(nlp.vocab))	    # extract all Docs from DocBin
-    return docs
+    check_components(col_name, features)
+    arrays = [np.load(PATH('..',f'storage{_S}','docdata',f'{col_name}_{field}.npy'), mmap_mode='r')
+              for field in ['vectors', 'orths', 'lemmas', 'offsets']]
+    with open(PATH('..',f'storage{_S}','docdata',f'{col_name}_strings.json')) as f:
+        strings = {int(lemma): string for lemma, string in json.load(f).items()}
+    return DocArrays(*arrays, strings)
 
-def store_as_array(relevance: pd.Series, score: pd.Series) -> None:
-    """Stores numerical data from two columns as a 2D NumPy array in the .npy file format"""
-    array = np.array(list(zip(relevance.values, score.values)))
-    loc = PATH('..',f'storage{_S}','arrays', score.name+'.npy')
-    np.save(loc, array)	    # store array to disk at specified location
+class QueryStore:
+
+    def __init__(self, nlp: spacy.Language, loc: str = None) -> None:
+        """
+        Opens (or creates) a persistent cache of parsed search queries: a SQLite file with the serialized `Doc` of
+        every query that was ever parsed, shared by all runs, datasets and the scoring service.
+        Queries are keyed by their exact string (anything else, like lowercasing or collapsing whitespace, would change
+        the docs) and by the spaCy version, model and enabled pipeline components, so an outdated doc is never reused.
+        ### params
+            - nlp: the spaCy `Language` object that parses the queries that are not in the cache
+            - loc: the location of the SQLite file, default is cache/queries.sqlite in the parent directory
+        """
+        from spacy import __version__ as spacy_version
+        self.nlp = nlp
+        self.namespace: str = artifact_key(spacy_version, nlp.meta.get('name'), nlp.meta.get('version'),
+                                           nlp.pipe_names)
+        if loc is None:
+            os.makedirs(PATH('..','cache'), exist_ok=True)
+            loc = PATH('..','cache','queries.sqlite')
+        self.connection = sqlite3.connect(loc, timeout=60, check_same_thread=False)    # the service parses in a worker thread
+        self.connection.execute('CREATE TABLE IF NOT EXISTS queries (namespace TEXT, query TEXT, doc BLOB,'
+                                ' parse_time REAL, PRIMARY KEY (namespace, query))')
+        self.lookups, self.hits = 0, 0
+        self.saved_time, self.parse_time = 0.0, 0.0
+
+    def pipe(self, queries: list[str], batch_size: int = 1000, n_process: int = 1) -> Iterator:
+        """
+        Yields the `Doc` of every query (in input order, like `nlp.pipe`), cached queries are deserialized,
+        the others are parsed all at once and added to the cache.
+        ### params
+            - queries: the query strings, duplicates are allowed
+            - batch_size: the amount of strings that are sent through the spaCy pipeline at once
+            - n_process: the amount of processes `nlp.pipe` spreads the batches over
+        """
+        from spacy.tokens import Doc
+        unique: list[str] = list(dict.fromkeys(queries))
+        stored: dict[str, tuple[bytes, float]] = {}
+        for start in range(0, len(unique), 500):    # SQLite limits the amount of parameters of a statement
+            batch: list[str] = unique[start:start+500]
+            stored.update((query, (doc, parse_time)) for query, doc, parse_time in self.connection.execute(
+                f'SELECT query, doc, parse_time FROM queries WHERE namespace = ? AND query IN ({",".join("?"*len(batch))})',
+                [self.namespace, *batch]))
+
+        docs: dict[str, Doc] = {query: Doc(self.nlp.vocab).from_bytes(doc) for query, (doc, _) in stored.items()}
+        missing: list[str] = [query for query in unique if query not in stored]
+        start: float = time.perf_counter()
+        for query, doc in zip(missing, self.nlp.pipe(missing, batch_size=batch_size, n_process=n_process)):
+            docs[query] = doc
+        parse_time: float = (time.perf_counter() - start) / max(len(missing), 1)
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?)',
+                                        [(self.namespace, query, docs[query].to_bytes(exclude=['tensor', 'user_data']),
+                                          parse_time) for query in missing])
+
+        self.lookups += len(unique)
+        self.hits += len(stored)
+        self.saved_time += sum(stored_time for _, stored_time in stored.values())
+        self.parse_time += parse_time * len(missing)
+        for query in queries:
+            yield docs[query]
+
+    def stats(self) -> dict[str, float]:
+        """
+        Returns the amount of queries that were looked up & found, and the parsing time that was saved.
+        Every call of `pipe()` looks up its distinct queries, so a query that occurs in several calls is counted every time.
+        """
+        return {'lookups': self.lookups, 'hits': self.hits, 'saved_time': self.saved_time,
+                'parse_time': self.parse_time}
+
+    def close(self) -> None:
+        """Closes the SQLite file, the parsed queries were already committed by `pipe()`"""
+        self.connection.close()
+
+def feature_dtype() -> np.dtype:
+    """The schema of the feature store: a row ID, the relevance and a float32 column for every feature"""
+    return np.dtype([('row_id', '<i8'), ('relevance', '<f4')] + [(col, '<f4') for col in FEATURE_COLUMNS])
+
+def open_feature_store(row_ids: np.ndarray, relevance: np.ndarray) -> None:
+    """
+    Creates the feature store (a single .npy file with one typed column per feature) for the given rows.
+    A store that already holds exactly these rows with the current schema is kept as it is,
+    otherwise a new one is created (with all features set to NaN) and all stored scores are invalidated.
+    ### params
+        - row_ids: the id of every row
+        - relevance: the relevance score of every row
+    """
+    loc = PATH('..',f'storage{_S}','arrays','features.npy')
+    if os.path.exists(loc):
+        store = np.load(loc, mmap_mode='r')
+        if store.dtype == feature_dtype() and np.array_equal(store['row_id'], row_ids) \
+                                          and np.array_equal(store['relevance'], relevance.astype(np.float32)):
+            return
+    store = np.lib.format.open_memmap(loc, mode='w+', dtype=feature_dtype(), shape=(len(row_ids),))
+    store['row_id'], store['relevance'] = row_ids, relevance
+    for col in FEATURE_COLUMNS:
+        store[col] = np.nan
+    store.flush()
+    invalidate('calc/')
+
+def store_feature(values: np.ndarray, col_name: str) -> list[str]:
+    """Writes the values of a single feature into its column of the feature store, returns the stored file"""
+    store = np.lib.format.open_memmap(PATH('..',f'storage{_S}','arrays','features.npy'), mode='r+')
+    store[col_name] = values
+    store.flush()
+    return ['arrays/features.npy']
+
+def load_features() -> np.ndarray:
+    """Memory-maps the feature store, every column (e.g. `features['len_of_query']`) can be read as a view"""
+    return np.load(PATH('..',f'storage{_S}','arrays','features.npy'), mmap_mode='r')
+
+def load_feature_frame(columns: list[str]) -> pd.DataFrame:
+    """
+    Loads the row IDs, the relevance and the given columns of the feature store into a `DataFrame`.
+    The relevance is rounded back to the two decimals of the original scores, as it is stored as float32.
+    """
+    features: np.ndarray = load_features()
+    return pd.DataFrame({'row_id': features['row_id'], 'relevance': features['relevance'].astype(np.float64).round(2)}
+                        | {col: features[col] for col in columns})
+
+def feature_matrix(features: np.ndarray, columns: list[str]) -> np.ndarray:
+    """
+    Returns the given float32 columns of the feature store as a 2D (rows x columns) array.
+    If the columns are next to each other in the store (in the given order), this is a view instead of a copy.
+    """
+    offsets: list[int] = [features.dtype.fields[col][1] for col in columns]
+    if all(features.dtype.fields[col][0] == np.float32 for col in columns) \
+       and offsets == list(range(offsets[0], offsets[0] + 4*len(columns), 4)):
+        return np.ndarray((len(features), len(columns)), dtype=np.float32, buffer=features,
+                          offset=offsets[0], strides=(features.itemsize, 4))
+    return np.stack([features[col] for col in columns], axis=1)
+
+def store_model(model, split: dict[str, np.ndarray], name: str) -> list[str]:
+    """
+    Stores a fitted model, together with the row IDs it was trained and tested on, in the models folder.
+    ### params
+        - model: the fitted scikit-learn estimator
+        - split: the row IDs of the train ('train') and test ('test') entries
+        - name: the name the model is stored under
+    
+    ### returns
+        - the stored files, relative to the storage folder
+    """
+    import joblib
+    create('models')
+    joblib.dump({'model': model, 'split': split}, PATH('..',f'storage{_S}','models',f'{name}.joblib'))
+    return [f'models/{name}.joblib']
 
-def load_array(col_name: str) -> np.ndarray:
-    """For a given column name, loads the NumPy array present on the user's disk"""
-    return np.load(PATH('..',f'storage{_S}','arrays',f'{col_name}.npy'))
+def load_model(name: str) -> tuple[object, dict[str, np.ndarray]]:
+    """Loads a fitted model and the row IDs it was trained and tested on from the models folder"""
+    import joblib
+    stored: dict = joblib.load(PATH('..',f'storage{_S}','models',f'{name}.joblib'))
+    return stored['model'], stored['split']
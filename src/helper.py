@@ -12,41 +12,103 @@ import warnings                 # suppressing specific warning
 import os, sys, re              # directories                                     |
 from datetime import datetime   # printing experiment starting time               |
 import time                     # getting time indications during the experiment  |
+import json, csv                # run reports                                     |
+import tracemalloc, cProfile    # memory tracing, profiling stages                |
+from typing import NamedTuple   # parsed arguments                                |
 # --------------------------------------------------------------------------------
 
 BOLD = lambda string: f'\033[1m{string}\033[0m'
 PATH = lambda *args: os.path.join(os.getcwd(), *args)
+ENGINES = {'forest': 'Random Forest Regressor', 'boosting': 'Histogram Gradient Boosting Regressor'}  # see model.py
 
-def argparse_wrapper(parser: argparse.ArgumentParser) -> tuple[str, bool, bool, bool, bool]:
+class Arguments(NamedTuple):
+    """The parsed command line arguments of main.py (see `argparse_wrapper()`)"""
+    s_suff: str           # determines if the sample dataset should be used, this will be included at all the right places
+    only: list[str]       # names of the stages or groups of stages that should be run (-p, -c, -d & -t add their group)
+    start: str            # if not None, the stage (or group) that is run together with all stages that depend on it
+    batch_size: int       # amount of strings that are sent through the spaCy pipeline at once while parsing
+    n_process: int        # amount of processes that are used while parsing
+    full_pipeline: bool   # toggles running all spaCy pipeline components instead of only the ones the features need
+    substring_hits: bool  # toggles counting simple similarity hits with the original substring matching
+    chunk_size: int       # if not 0, parsing and calculating is done on chunks of this many rows (replaces -p and -c)
+    plot_sample: int      # amount of data points the densities in the distribution plots are estimated on (0 means all)
+    n_jobs: int           # amount of stages that run at the same time, and of processes that train with (-1 means all cores)
+    predict_file: str     # if not None, a csv file with feature columns whose relevance is predicted by the stored model
+    tune_budget: float    # if not 0, the amount of seconds that can be spent on searching for better model parameters
+    profile: str          # if not None, the stages whose name contains this string are profiled with cProfile
+    trace_memory: bool    # toggles tracing the Python memory allocations of every stage
+    memory_budget: float  # if not None, the amount of MB that the stages that run at the same time can use together
+    query_cache: bool     # toggles taking parsed search terms from (and adding them to) the persistent query cache
+    engines: list[str]    # the regression model engines that are trained side by side, the first one predicts
+
+def argparse_wrapper(parser: argparse.ArgumentParser) -> Arguments:
     """
     Returns the parsed arguments of the file.
     ### params
         - the argparse `ArgumentParser` object that was instantiated in main.py
     
     ### returns
-        - s_suff: determines if the sample dataset should be used, this will be included at all the right places
-        - p_flag: toggles parsing of the string data into spaCy `Doc` objects
-        - c_flag: toggles calculating all metrics and storing this as NumPy arrays
-        - d_flag: toggles distribution plotting
-        - t_flag: toggles training and testing
+        - the parsed arguments, by name (see `Arguments`)
     """
     parser.add_argument('-f', '--full', action='store_true',
                         help='run script on full dataset, default is to run on sample data')
     parser.add_argument('-p', '--parse', action='store_true',
-                        help='parse string data into spaCy docs, required for first run!')
+                        help='parse string data into spaCy docs, required for first run! (same as --only parse)')
+    parser.add_argument('-b', '--batch_size', type=int, default=1000,
+                        help='amount of strings that are sent through the spaCy pipeline at once while parsing')
+    parser.add_argument('-n', '--n_process', type=int, default=1,
+                        help='amount of processes to parse with, -1 uses all available cores')
+    parser.add_argument('--full_pipeline', action='store_true',
+                        help='run all spaCy pipeline components while parsing, default is to only run what the features need')
     parser.add_argument('-c', '--calc_sim', action='store_true',
-                        help='calculate similarity scores, parsed data needs to be present on disk!')
+                        help='calculate similarity scores, parsed data needs to be present on disk! (same as --only features)')
+    parser.add_argument('-s', '--stream', type=int, default=0, metavar='CHUNK_SIZE',
+                        help='parse & calculate similarity scores chunk by chunk to limit memory usage (replaces -p and -c)')
+    parser.add_argument('--substring_hits', action='store_true',
+                        help='count a simple similarity hit whenever a query lemma occurs inside the product text (old scores)')
     parser.add_argument('-d', '--dis_plots', action='store_true',
-                        help='create and store distribution plots, similarity data needs to be present on disk!')
+                        help='create and store distribution plots, similarity data needs to be present on disk! (same as --only plot)')
+    parser.add_argument('--plot_sample', type=int, default=10_000,
+                        help='amount of data points the plotted densities are estimated on, 0 uses all data points')
+    parser.add_argument('-j', '--n_jobs', type=int, default=-1,
+                        help='amount of stages that run at the same time and of processes to train & tune with, default (-1) uses all available cores')
     parser.add_argument('-t', '--train_test', action='store_true',
-                        help='train and test a RF regression model on all numerical data that is present on disk')
+                        help='train and test a RF regression model on all numerical data that is present on disk (same as --only train)')
+    parser.add_argument('--engine', nargs='+', default=['forest'], choices=list(ENGINES),
+                        help='regression model engine(s) to train & compare, the first one predicts (boosting is histogram-based gradient boosting)')
+    parser.add_argument('--only', nargs='+', default=[], metavar='STAGE',
+                        help='run these stages (e.g. parse/search_term) or groups of stages (parse, features, plot, train)')
+    parser.add_argument('--from', dest='start', type=str, default=None, metavar='STAGE',
+                        help='run this stage (or group of stages) and all stages that depend on it')
+    parser.add_argument('--memory_budget', type=float, default=None, metavar='MB',
+                        help='amount of memory the stages that run at the same time can use together, default is 3/4 of the RAM')
+    parser.add_argument('--no_query_cache', action='store_true',
+                        help='parse every search term again, instead of reusing the ones parsed in earlier runs')
+    parser.add_argument('--tune', type=float, default=0, metavar='SECONDS',
+                        help='search for better RF regression model parameters for at most about this many seconds')
+    parser.add_argument('--profile', type=str, default=None, metavar='STAGE',
+                        help='profile the stages whose name contains STAGE (e.g. "parse/search_term" or "features") with cProfile')
+    parser.add_argument('--trace_memory', action='store_true',
+                        help='record the Python memory allocations of every stage in the run report (slower)')
+    parser.add_argument('--predict', type=str, default=None, metavar='CSV_FILE',
+                        help='predict the relevance of the rows (feature columns) in a csv file with the stored model')
     
-    s_suff = '' if parser.parse_args().full else '_sample'
-    p_flag = parser.parse_args().parse
-    c_flag = parser.parse_args().calc_sim
-    d_flag = parser.parse_args().dis_plots
-    t_flag = parser.parse_args().train_test
-    return (s_suff, p_flag, c_flag, d_flag, t_flag)
+    args = parser.parse_args()
+    if args.n_jobs == 0:
+        print(f'\nERROR: {BOLD("-j")} cannot be 0, negative amounts count back from the amount of cores',
+              '(-1 uses all cores, -2 all cores but one, ...).\n')
+        sys.exit(1)
+    flags = [args.parse, args.calc_sim, args.dis_plots, args.train_test]
+    return Arguments(s_suff='' if args.full else '_sample',
+                     only=[group for group, flag in zip(['parse', 'features', 'plot', 'train'], flags) if flag] + args.only,
+                     start=args.start, batch_size=args.batch_size, n_process=args.n_process,
+                     full_pipeline=args.full_pipeline, substring_hits=args.substring_hits, chunk_size=args.stream,
+                     plot_sample=args.plot_sample, n_jobs=args.n_jobs,
+                     # the working directory is changed to src later on
+                     predict_file=None if args.predict is None else os.path.abspath(args.predict),
+                     tune_budget=args.tune, profile=args.profile, trace_memory=args.trace_memory,
+                     memory_budget=args.memory_budget, query_cache=not args.no_query_cache,
+                     engines=list(dict.fromkeys(args.engine)))
 
 def suppress_W008() -> None:
     """Suppresses useless warning that (correctly) states some of the words in the data are not recognized by spaCy"""
@@ -73,54 +135,193 @@ def fix_dirs(s_suff: str) -> None:
     if not os.path.exists(results_dir := PATH('..',f'results{_S}')):
         os.mkdir(results_dir)
 
-def print_pipeline(datasets: list[str], p_flag: bool, c_flag: bool, d_flag: bool, t_flag: bool) -> None:
-    """Prints how the pipeline will be executed based on the datasets and the flags provided by the user"""
+def print_pipeline(datasets: list[str], stages: list[str], chunk_size: int = 0, predict_file: str = None,
+                   tune_budget: float = 0, engine: str = 'forest') -> None:
+    """Prints how the pipeline will be executed based on the datasets, the selected stages and the other arguments"""
     relevant_columns = {'train': ['product_title', 'search_term'],
                         'product_descriptions': ['product_description']}
     
     datasets_to_read = ', '.join([ds+_S+'.csv' for ds in datasets])
     columns_to_parse = ', '.join(set(col for dataset in datasets for col in relevant_columns[dataset]))
     columns_to_calc = columns_to_parse.replace('search_term, ', '').replace(', search_term', '')
-    columns_to_plot = columns_to_calc
-
-    pipeline: list[str] = [f'read {datasets_to_read}']
-
-    if p_flag:
-        pipeline += [f'parse {columns_to_parse} data into spaCy docs', 'store spaCy doc data to disk']
-    if c_flag:
-        pipeline += [f'load stored spaCy doc data into columns {columns_to_parse}',
-                     'calculate length of search_term'
-                     f'calculate similarity scores for {columns_to_calc}',
-                     'store scores to disk as arrays']
-    if d_flag:
-        pipeline += [f'load stored scores into columns {columns_to_plot}', 'plot data distributions',
-                     'save distribution plots to disk']
-    if t_flag:
-        pipeline += ['train Random Forest Regressor on numerical data',
-                     'test accuracy of the Random Forest Regressor on separate test set']
+
+    pipeline: list[str] = [f'hash {datasets_to_read}']
+
+    if chunk_size:
+        pipeline += [f'read train{_S}.csv in chunks of {chunk_size} rows, look up product descriptions on disk',
+                     f'parse every chunk\'s {columns_to_parse} data into spaCy docs',
+                     f'calculate length of search_term and similarity scores for {columns_to_calc} per chunk',
+                     'append doc vectors and token IDs to disk',
+                     f'index the lemmas of all parsed {columns_to_calc} data, calculate TF-IDF & BM25 scores'
+                     ' of the stored search terms chunk by chunk',
+                     'store token vector tables, store scores in the feature store']
+    if stages:
+        pipeline += ['run the following stages as soon as their inputs are stored, side by side if memory allows:']
+        pipeline += [f'  {stage}' for stage in stages]
+    if tune_budget:
+        pipeline += [f'search for better Random Forest Regressor parameters for about {tune_budget:g} s',
+                     'save leaderboard of cross-validated RMSE and fit/predict times to disk']
+    if predict_file:
+        pipeline += [f'load the stored {ENGINES[engine]}', f'predict relevance of the rows in {predict_file}',
+                     'save predictions to disk']
     
     print('\npipeline:')
     for pipe in pipeline: print('*', pipe)
 
+def print_filter_report(removed: dict[str, int], n_rows: int) -> None:
+    """Prints how many entries each filtering rule removed (see `filter_mask()`)"""
+    print(f'filtered {BOLD(sum(removed.values()))} out of {n_rows} entries:')
+    for rule, n_removed in removed.items():
+        print(f'* {rule}: {n_removed}')
+
+def print_engine_report(results: dict[str, dict]) -> None:
+    """Prints the training time & RMSE of every trained regression model engine next to each other"""
+    print(f'\n{"engine":<10} {"train time":>12} {"RMSE":>9}')
+    for engine, result in results.items():
+        RMSE: str = f'{result["RMSE"]:>9.5f}'
+        print(f'{engine:<10} {result["train_time"]:>10.2f} s {BOLD(RMSE)}')
+
+def print_cache_report(stats: dict[str, float]) -> None:
+    """Prints how many search term lookups found the search term in the persistent query cache (see `QueryStore.stats()`)"""
+    hit_rate: float = stats['hits'] / stats['lookups'] if stats['lookups'] else 0.0
+    print(f'query cache: {BOLD(stats["hits"])} of {stats["lookups"]} search term lookups were cached ({hit_rate:.1%}),',
+          f'saving about {BOLD(round(stats["saved_time"], 2))} s of parsing ({stats["parse_time"]:.2f} s spent)')
+
 class Timer:
 
-    def __init__(self, first_process: str) -> None:
-        """Sets up a timer object and prints the name of the first process"""
-        print(f'\nexperiment started at {datetime.now().strftime("%H:%M:%S")}')
+    def __init__(self, first_process: str, profile: str = None, trace_memory: bool = False,
+                 startup_time: float = None) -> None:
+        """
+        Sets up a timer object and prints the name of the first process.
+        Besides printing how long every process (stage) takes, it records the wall time, CPU time, peak RSS
+        and rows per second of every stage, which are written to a run report at the end of the experiment.
+        ### params
+            - first_process: the name of the first stage
+            - profile: stages whose name contains this string are profiled with cProfile
+            - trace_memory: toggles recording the Python memory allocations of every stage with tracemalloc
+            - startup_time: the amount of seconds it took to import the script and parse its arguments
+        """
+        print(f'\nexperiment started at {datetime.now().strftime("%H:%M:%S")}', end='')
+        print(f' (startup took {BOLD(round(startup_time, 2))} s)' if startup_time is not None else '')
         print(f'\n{first_process}: ', end='')
+        self.started: datetime = datetime.now()
+        self.run_id: str = f'{self.started:%Y%m%d_%H%M%S}'
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.stages: list[dict] = []
+        self.startup_time = startup_time
+        if trace_memory:
+            tracemalloc.start()
         self.start: float = time.perf_counter()
-        self.tic: float = time.perf_counter()
+        self._begin(first_process)
 
     def __call__(self, next_process: str = None) -> None:
         """Prints the time it took to complete the previous process and if specified, the name of the next process"""
-        passed: float = round((toc := time.perf_counter()) - self.tic, 2)
-        print(f'{BOLD(passed)} s', end='')
+        stage: dict = self._end()
+        print(f'{BOLD(round(stage["wall_time"], 2))} s', end='')
+        if stage['rows']:
+            print(f' ({stage["rows_per_sec"]:,.0f} rows/s)', end='')
         if next_process is not None:
             print(f'\n{next_process}: ', end='')
-            self.tic = toc
+            self._begin(next_process)
         else:
             print()
             total_time: float = time.perf_counter() - self.start
             minutes, seconds = int((total_time) // 60), round((total_time) % 60, 1)
             total_time_string = f'{minutes}:{str(seconds).zfill(4)} min' if minutes else f'{seconds} sec\n'
             print(f'\nexperiment took {total_time_string}')
+            print(f'run report saved to {BOLD(self.report(total_time))}')
+
+    def record(self, stage: dict) -> None:
+        """Adds the record of a stage that was measured elsewhere (e.g. in a worker process) to the run report"""
+        self.stages.append(stage)
+
+    def count(self, rows: int) -> None:
+        """Adds to the amount of rows that were processed in the current stage"""
+        self.stage['rows'] += int(rows)
+
+    def _begin(self, process: str) -> None:
+        """Starts recording a stage"""
+        self.stage: dict = {'stage': process, 'rows': 0}
+        reset_peak_rss()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            self.traced: int = tracemalloc.get_traced_memory()[0]
+        self.profiler = cProfile.Profile() if self.profile and self.profile in process else None
+        self.cpu: float = time.process_time()
+        self.tic: float = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def _end(self) -> dict:
+        """Stops recording the current stage, and returns its record"""
+        if self.profiler is not None:
+            self.profiler.disable()
+        wall_time: float = time.perf_counter() - self.tic
+        self.stage |= {'wall_time': wall_time, 'cpu_time': time.process_time() - self.cpu,
+                       'rows_per_sec': self.stage['rows'] / wall_time if wall_time else 0.0,
+                       'peak_rss_mb': peak_rss()}
+        if self.trace_memory:
+            current, peak = tracemalloc.get_traced_memory()
+            self.stage |= {'traced_delta_mb': (current - self.traced) / 2**20, 'traced_peak_mb': peak / 2**20}
+        if self.profiler is not None:
+            self.stage['profile'] = save_profile(self.profiler, self.stage['stage'], self.run_id, _S)
+        self.stages.append(self.stage)
+        return self.stage
+
+    def report(self, total_time: float) -> str:
+        """
+        Writes the records of all stages to a JSON report of this run, and appends them to a CSV file
+        that holds the stages of all runs, so runs can be compared over time.
+        ### params
+            - total_time: the amount of seconds the whole experiment took
+
+        ### returns
+            - the location of the JSON report, relative to the parent directory
+        """
+        run_id: str = self.run_id
+        os.makedirs(PATH('..',f'results{_S}','runs'), exist_ok=True)
+        loc = PATH('..',f'results{_S}','runs',f'{run_id}.json')
+        with open(loc, 'w') as f:
+            json.dump({'run': run_id, 'command': ' '.join(sys.argv), 'startup_time': self.startup_time,
+                       'total_time': total_time, 'stages': self.stages}, f, indent=2)
+
+        fields: list[str] = ['run', 'stage', 'rows', 'wall_time', 'cpu_time', 'rows_per_sec', 'peak_rss_mb',
+                             'traced_delta_mb', 'traced_peak_mb', 'profile']
+        csv_loc = PATH('..',f'results{_S}','runs.csv')
+        new_file: bool = not os.path.exists(csv_loc)
+        with open(csv_loc, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            if new_file:
+                writer.writeheader()
+            writer.writerows({'run': run_id} | stage for stage in self.stages)
+        return os.path.relpath(loc, PATH('..'))
+
+def save_profile(profiler: cProfile.Profile, stage: str, run_id: str, s_suff: str) -> str:
+    """Dumps the statistics of a profiled stage next to the run report, returns their location relative to the parent directory"""
+    os.makedirs(PATH('..',f'results{s_suff}','runs'), exist_ok=True)
+    slug: str = re.sub(r'\W+', '_', stage).strip('_')
+    loc = PATH('..',f'results{s_suff}','runs',f'{run_id}_{slug}.prof')
+    profiler.dump_stats(loc)   # inspect with `python -m pstats <file>` or snakeviz
+    return os.path.relpath(loc, PATH('..'))
+
+def reset_peak_rss() -> None:
+    """Resets the peak RSS of the process (Linux only), so it can be measured per stage"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass    # the peak RSS of a stage will then be the peak of the whole run so far
+
+def peak_rss() -> float:
+    """Returns the peak resident set size of the process in MB (of the stage, if it could be reset), NaN if unknown"""
+    try:
+        with open('/proc/self/status') as f:
+            return next(int(line.split()[1]) for line in f if line.startswith('VmHWM:')) / 2**10
+    except (OSError, StopIteration):
+        try:
+            import resource
+            rss: int = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10    # bytes on macOS, kB elsewhere
+        except ImportError:
+            return float('nan')
@@ -6,23 +6,132 @@ Script that should be run to generate all results.
 Data Science Assignment 3 - Home Depot Search Results
 """
 
-# python standard library ----------------------------------
-import argparse         # specifying args from command line |
-# dependencies ---------------------------------------------
-import pandas as pd     # dataframes                        |
-import spacy            # natural language processing       |
+from __future__ import annotations  # type hints of lazily imported modules
+# python standard library ----------------------------------------------------------
+import time                             # startup time                      |
+STARTED: float = time.perf_counter()    # before the other imports, so the startup time includes them
+import argparse                         # specifying args from command line |
+from functools import partial           # saving profiles                   |
+from typing import TYPE_CHECKING        # type hints                        |
+from importlib.metadata import version  # printing versions                 |
+# dependencies ---------------------------------------------------------------------
+import numpy as np                      # arrays                            |
+import pandas as pd                     # dataframes                        |
+if TYPE_CHECKING:                       # spaCy, sklearn & the plotting libraries are slow to import, so they
+    import spacy                        # are only imported once a stage that needs them is run
 # local imports --------------------------------------------------------------------
-from helper import (argparse_wrapper, suppress_W008,            # general utilities |
-                    fix_dirs, print_pipeline, Timer)            # ...               |
+from helper import (argparse_wrapper, Arguments, PATH,          # general utilities |
+                    suppress_W008,                              # ...               |
+                    fix_dirs, print_pipeline, Timer,            # ...               |
+                    print_filter_report, print_cache_report,    # ...               |
+                    print_engine_report, save_profile)          # ...               |
 from datamanager import (load_dataframes, create, require,      # data management   |
-                         store_as_docbin, load_docs,            # ...               |
-                         store_as_array, load_array)            # ...               |
-from processing import (parse_data, calc_semantic_similarity,   # processing data   |
-                        calc_simple_similarity, calc_length)    # ...               |
-from plot import plot_distributions                             # plotting          |
-from model import train_and_test, show_feature_importances      # regression model  |
+                         input_hash, package_versions,          # ...               |
+                         stream_dataframe, ProductLookup,       # ...               |
+                         DocArraysAppender, load_feature_frame, # ...               |
+                         is_valid, register,                    # ...               |
+                         missing_components,                    # ...               |
+                         store_product_index, PRODUCT_COLUMNS,  # ...               |
+                         open_feature_store, store_feature,     # ...               |
+                         store_token_vectors, QueryStore,       # ...               |
+                         load_model, artifact_keys,             # ...               |
+                         METRIC_COLUMNS, store_product_uids)    # ...               |
+from processing import (load_pipeline, FEATURES, docbin_attrs,  # processing data   |
+                        MODEL, filter_mask,                     # ...               |
+                        parse_data, DocArrays,                  # ...               |
+                        compute_features, SparseTermIndex,      # ...               |
+                        token_vector_table)                     # ...               |
+from scheduler import Scheduler, select                         # running stages    |
+from stages import Settings, build_stages, init_worker          # ...               |
 # ----------------------------------------------------------------------------------
 
+def stream(datasets: list[str], s_suff: str, chunk_size: int, nlp: spacy.Language, batch_size: int, n_process: int,
+           attrs: list[str], substring_hits: bool, parse_key, calc_key, metric_cols: dict[str, str], timer: Timer,
+           cache: QueryStore = None) -> None:
+    """
+    Parses the data and calculates all scores chunk by chunk, which replaces the -p and -c stages.
+    Train rows are read in chunks, product descriptions are read from disk when a product is first seen,
+    and parsed data is appended to disk, so the peak memory usage depends on the chunk size instead of the dataset size.
+    The exceptions are the lemma index that TF-IDF & BM25 need of every product column (which is built once all
+    products are parsed, after which the stored search terms are scored chunk by chunk) and the token vector tables,
+    whose sizes depend on the amount of unique products and distinct tokens.
+    Only the doc arrays are stored (no `DocBin` objects), as they are all that the later stages need.
+    """
+    train, product_descriptions = datasets
+    create('docdata')
+    create('arrays')
+
+    timer('indexing product descriptions')
+    descriptions = ProductLookup(product_descriptions)
+    appenders = {col: DocArraysAppender(col, nlp.vocab.vectors.shape[1], nlp.pipe_names, nlp.component_names) for col in ['search_term', *PRODUCT_COLUMNS]}
+    product_positions: dict[int, int] = {}
+    product_index, row_ids, relevance = [], [], []
+    scores: dict[str, list[np.ndarray]] = {metric: [] for metric in metric_cols}
+    distinct_orths: dict[str, np.ndarray] = {col: np.zeros(0, dtype=np.uint64) for col in appenders}
+
+    for i, chunk in enumerate(stream_dataframe(train, s_suff, chunk_size)):
+        timer(f'parsing chunk {i}')
+        timer.count(len(chunk))
+        chunk = chunk[[uid in descriptions for uid in chunk['product_uid']]]
+        new_products: pd.DataFrame = chunk[~chunk['product_uid'].isin(product_positions.keys())
+                                           & ~chunk['product_uid'].duplicated()]
+        for uid in new_products['product_uid']:
+            product_positions[uid] = len(product_positions)
+        chunk_index = chunk['product_uid'].map(product_positions).values.astype(np.int64)
+
+        _, search_terms = parse_data(chunk['search_term'], nlp, batch_size, n_process, attrs, cache, docbin=False)
+        new_descriptions = pd.Series([descriptions[uid] for uid in new_products['product_uid']], dtype=object)
+        parsed: dict[str, DocArrays] = {'search_term': search_terms,
+                                        'product_title': parse_data(new_products['product_title'], nlp, batch_size,
+                                                                    n_process, attrs, docbin=False)[1],
+                                        'product_description': parse_data(new_descriptions, nlp, batch_size,
+                                                                          n_process, attrs, docbin=False)[1]}
+        for col, doc_arrays in parsed.items():
+            appenders[col].append(doc_arrays)
+            distinct_orths[col] = np.union1d(distinct_orths[col], doc_arrays.orths)    # at most the vocabulary
+
+        timer(f'calculating scores of chunk {i}')
+        timer.count(len(chunk))
+        # only the products of this chunk are gathered, TF-IDF & BM25 are scored once all products are parsed
+        products: dict[str, DocArrays] = {col: appenders[col].view() for col in PRODUCT_COLUMNS}
+        for metric, values in compute_features(search_terms, products, chunk_index, ('len', 'sem', 'sim', 'tok'),
+                                               substring_hits, subset=True, nlp=nlp).items():
+            scores[metric].append(values)
+        product_index.append(chunk_index)
+        row_ids.append(chunk['id'].values)
+        relevance.append(chunk['relevance'].values)
+        del chunk, new_products, search_terms, parsed, products     # help Python with garbage collection
+
+    # TF-IDF & BM25 weigh every lemma by the products it occurs in, so the products are indexed once all are parsed,
+    # after which the stored search terms are read back and scored chunk by chunk
+    product_index = np.concatenate(product_index)
+    queries: DocArrays = appenders['search_term'].view()
+    for col in PRODUCT_COLUMNS:
+        timer(f'indexing the lemmas of {col}')
+        products = {col: appenders[col].view()}
+        term_indexes = {col: SparseTermIndex(products[col])}
+        timer(f'calculating sparse similarity scores search_term <-> {col}')
+        timer.count(len(product_index))
+        for start in range(0, len(product_index), chunk_size):
+            rows: np.ndarray = np.arange(start, min(start + chunk_size, len(product_index)))
+            for metric, values in compute_features(queries.subset(rows), products, product_index[rows],
+                                                   ('tfidf', 'bm25'), term_indexes=term_indexes).items():
+                scores[metric].append(values)
+        del products, term_indexes      # help Python with garbage collection
+
+    timer('building token vector tables')
+    tables = {col: token_vector_table(nlp, orths) for col, orths in distinct_orths.items()}
+
+    timer('saving parsed data and scores to disk')
+    register('parse/product_index', parse_key('product_index'), store_product_index(product_index))
+    register('parse/product_uids', parse_key('product_uids'), store_product_uids(np.fromiter(product_positions, np.int64)))
+    for col, appender in appenders.items():
+        register(f'parse/{col}', parse_key(col), appender.close())
+        register(f'parse/{col}/tokens', parse_key(f'{col}/tokens'), store_token_vectors(tables[col], col))
+    open_feature_store(np.concatenate(row_ids), np.concatenate(relevance))
+    for metric, col in metric_cols.items():
+        register(f'calc/{metric}', calc_key(metric, col), store_feature(np.concatenate(scores[metric]), metric))
+
 def main():
     
     # ------------------ #
@@ -30,114 +139,143 @@ def main():
     # ------------------ #
 
     datasets = ['train', 'product_descriptions']
-    nlp: spacy.Language = spacy.load('en_core_web_lg')
-
-    print(f'pandas: v{pd.__version__}, spaCy: v{spacy.__version__}')
 
     arg_parser = argparse.ArgumentParser()
-    s_suff, p_flag, c_flag, d_flag, t_flag = argparse_wrapper(arg_parser)
+    args: Arguments = argparse_wrapper(arg_parser)
+
+    print(f'pandas: v{pd.__version__}, spaCy: v{version("spacy")}')
     suppress_W008()
-    fix_dirs(s_suff)
-    print_pipeline(datasets, p_flag, c_flag, d_flag, t_flag)
-
-    timer = Timer(first_process='reading original csv files')
-    dataframes: list[pd.DataFrame] = load_dataframes(datasets, s_suff)
-    df_train, df_prod_desc = dataframes
-    dataframe = pd.merge(df_train, df_prod_desc, how='left', on='product_uid')
-
-
-    if p_flag:
-        create('docbins')
-        # --------------------------------- #
-        # PARSING STRING DATA TO SPACY DOCS #
-        # --------------------------------- #
-        
-        for col in ['search_term', 'product_title', 'product_description']:
-            timer(f'parsing {col}')
-            s: pd.Series = dataframe[col]
-            db: spacy.tokens.DocBin = parse_data(s, nlp)
-            timer('saving parsed data to disk')
-            store_as_docbin(db, s.name)
-            dataframe.drop(col, axis=1, inplace=True)
-            del s, db   # help Python with garbage collection
-
-
-    if c_flag:
-        require('docbins')
-        create('arrays')
-        # ----------------------------- #
-        # CALCULATING SIMILARITY SCORES #
-        # ----------------------------- #
-
-        timer('reading search_term spacy docs')
-        dataframe['search_term'] = load_docs('search_term', nlp)
-        
-        timer('calculating query length')
-        dataframe['len_of_query'] = calc_length(dataframe['search_term'])
-        store_as_array(dataframe['relevance'], dataframe['len_of_query'])
-        dataframe.drop('len_of_query', axis=1, inplace=True)
-
-        for col in ['product_title', 'product_description']:
-            timer(f'reading {col} spacy docs')
-            docs: list[spacy.tokens.Doc] = load_docs(col, nlp)
-            dataframe[col] = docs
-            del docs    # help Python with garbage collection
-
-            timer(f'calculating semantic similarity search_term <-> {col}')
-            dataframe[f'zipped_{col}'] = tuple(zip(dataframe['search_term'], dataframe[col]))
-            dataframe[f'sem_sim_{col}'] = calc_semantic_similarity(dataframe[f'zipped_{col}'])
-
-            timer(f'calculating simple similarity search_term <-> {col}')
-            dataframe[f'sim_sim_{col}'] = calc_simple_similarity(dataframe[f'zipped_{col}'])
-
-            store_as_array(dataframe['relevance'], dataframe[f'sem_sim_{col}'])
-            store_as_array(dataframe['relevance'], dataframe[f'sim_sim_{col}'])
-            dataframe.drop([col, f'zipped_{col}', f'sem_sim_{col}', f'sim_sim_{col}'], axis=1, inplace=True)
-        
-        dataframe.drop('search_term', axis=1, inplace=True)
-
-
-    if d_flag:
-        require('arrays')
-        # ---------------------- #
-        # PLOTTING DISTRIBUTIONS #
-        # ---------------------- #
-
-        translate = lambda x: x.replace('sim_sim_', 'simple similarity ')\
-                               .replace('sem_sim_', 'semantic similarity ')
-
-        for col in ['product_title', 'product_description']:
-            for sim_kind in ['sem', 'sim']:
-                metric: str = f'{sim_kind}_sim_{col}'
-                timer(f'creating {translate(metric)} plots')
-                array = load_array(f'{metric}')
-                dataframe[f'{metric}'] = array[:,1]
-                plot_distributions(dataframe, metric, s_suff)
-                dataframe.drop(metric, axis=1, inplace=True)
-
-    RMSE = None
-    if t_flag:
-        require('arrays')
-        # -------------------------- #
-        # TRAINING AND TESTING MODEL #
-        # -------------------------- #
+    fix_dirs(args.s_suff)
+    settings = Settings(args.s_suff, tuple(datasets), args.batch_size, args.n_process, args.full_pipeline,
+                        args.substring_hits, args.plot_sample, args.n_jobs, args.query_cache, tuple(args.engines))
+    stages = select(build_stages(settings), args.only, args.start)
+    if args.chunk_size:  # streaming replaces the parse & features stages
+        stages = [stage for stage in stages if stage.name.split('/')[0] not in ['parse', 'features']]
+    print_pipeline(datasets, [f'{stage.name}: {stage.description}' for stage in stages], args.chunk_size,
+                   args.predict_file, args.tune_budget, args.engines[0])
+
+    timer = Timer(first_process='hashing original csv files', profile=args.profile, trace_memory=args.trace_memory,
+                  startup_time=time.perf_counter() - STARTED)
+    inputs: str = input_hash(datasets, args.s_suff)
+    versions: list[str] = package_versions('spacy', MODEL)
+    parse_key, calc_key, model_key = artifact_keys(inputs, versions, args.full_pipeline, args.substring_hits)
+    metric_cols: dict[str, str] = METRIC_COLUMNS
+
+    def key_of(artifact: str) -> str:
+        """Returns the current key of a stored artifact (see `artifact_keys()`), by artifact name"""
+        kind, name = artifact.split('/', 1)
+        return {'parse': lambda: parse_key(name), 'calc': lambda: calc_key(name, metric_cols[name]),
+                'model': lambda: model_key(name)}[kind]()
+
+    # stored docs that were parsed without a pipeline component the features need are parsed again, with all scores
+    reparse: list[str] = [col for col in ['search_term', *PRODUCT_COLUMNS]
+                          if is_valid(f'parse/{col}', parse_key(col)) and missing_components(col)]
+
+    def valid(artifact: str) -> bool:
+        """Checks if an up to date version of an artifact is stored, which is never the case for docs that are parsed again"""
+        kind, name = artifact.split('/', 1)
+        if reparse and (kind == 'calc' or kind == 'parse' and name.split('/')[0] in reparse):
+            return False
+        return is_valid(artifact, key_of(artifact))
+
+    query_stats: dict[str, float] = None
+    if args.chunk_size:
+        # --------------------------------------- #
+        # STREAMING: PARSING & CALCULATING SCORES #
+        # --------------------------------------- #
+
+        if all(valid(f'calc/{metric}') for metric in metric_cols) and valid('parse/product_uids'):
+            timer('streaming (stored scores are up to date, skipping)')
+        else:
+            timer(f'loading spaCy pipeline {MODEL}')
+            nlp: spacy.Language = load_pipeline(MODEL, FEATURES, minimal=not args.full_pipeline)
+            attrs = None if args.full_pipeline else docbin_attrs(FEATURES)
+            cache = QueryStore(nlp) if args.query_cache else None
+            stream(datasets, args.s_suff, args.chunk_size, nlp, args.batch_size, args.n_process, attrs,
+                   args.substring_hits, parse_key, calc_key, metric_cols, timer, cache)
+            if cache is not None:
+                cache.close()
+                query_stats = cache.stats()
+            del nlp     # help Python with garbage collection
+
+    results: dict[str, object] = {}
+    if stages:
+        # -------------------------------------------- #
+        # RUNNING PARSE, FEATURES, PLOT & TRAIN STAGES #
+        # -------------------------------------------- #
+
+        scheduler = Scheduler(stages, valid,
+                              lambda artifact, files: register(artifact, key_of(artifact), files),
+                              args.n_jobs, args.memory_budget, init_worker, (args.s_suff,), args.profile,
+                              args.trace_memory, partial(save_profile, run_id=timer.run_id, s_suff=args.s_suff))
+        if any(stage.name.startswith('features/') and scheduler.outdated(stage) for stage in stages):
+            timer('opening the feature store')
+            create('arrays')
+            df_train: pd.DataFrame = load_dataframes(datasets[:1], args.s_suff)[0]
+            open_feature_store(df_train['id'].values, df_train['relevance'].values)
+            del df_train    # help Python with garbage collection
+
+        timer(f'running {len(stages)} stages')
+        results = scheduler.run()
+        for record in scheduler.records:
+            timer.record(record)
+
+    query_stats = results.get('parse/search_term', query_stats)
+    trainings: dict[str, dict] = {engine: results[f'train/{engine}'] for engine in args.engines
+                                  if f'train/{engine}' in results}
+    training: dict = next(iter(trainings.values()), None)
+    leaderboard = None
+    if args.tune_budget or args.predict_file:
+        timer('importing scikit-learn')
+        from model import predict, FILTERED_COLUMNS, tune
+
+    if args.tune_budget:
+        for metric, col in metric_cols.items():
+            require(f'calc/{metric}', calc_key(metric, col))
+        # ---------------------------- #
+        # TUNING MODEL HYPERPARAMETERS #
+        # ---------------------------- #
 
         timer('loading in all numerical data')
-        dataframe['len_of_query'] = load_array('len_of_query')[:,1]
+        dataframe: pd.DataFrame = load_feature_frame(list(metric_cols))
+
+        timer('filtering data')
+        keep, removed = filter_mask(dataframe, FILTERED_COLUMNS)
+        timer.count(len(dataframe))
+
+        timer('tuning hyperparameters')
+        leaderboard: pd.DataFrame = tune(dataframe, keep, args.tune_budget, n_jobs=args.n_jobs)
+        leaderboard.to_csv(PATH('..',f'results{args.s_suff}','leaderboard.csv'), index=False)
+        if training is None:
+            training = {'removed': removed, 'n_rows': len(dataframe)}
 
-        for col in ['product_title', 'product_description']:
-            for sim_kind in ['sem', 'sim']:
-                metric: str = f'{sim_kind}_sim_{col}'
-                array = load_array(f'{metric}')
-                dataframe[f'{metric}'] = array[:,1]
+    if args.predict_file:
+        require(f'model/{args.engines[0]}', model_key(args.engines[0]))
+        # ---------------------------- #
+        # PREDICTING WITH STORED MODEL #
+        # ---------------------------- #
 
-        timer('training and testing')
-        RMSE = train_and_test(dataframe)
-        show_feature_importances(dataframe)
+        timer(f'predicting relevance of {args.predict_file}')
+        model, _ = load_model(args.engines[0])
+        new_rows: pd.DataFrame = pd.read_csv(args.predict_file)
+        new_rows['relevance'] = predict(model, new_rows)
+        timer.count(len(new_rows))
+        new_rows.to_csv(PATH('..',f'results{args.s_suff}','predictions.csv'), index=False)
 
 
     timer()
-    if RMSE is not None: print(f'RMSE: {RMSE:.5f}')
+    if query_stats is not None:
+        print_cache_report(query_stats)
+    if training is not None:
+        print_filter_report(training['removed'], training['n_rows'])
+    if trainings:
+        print_engine_report(trainings)
+    if leaderboard is not None and leaderboard.empty:
+        print('\nno parameters could be scored within the time budget, please increase it')
+    elif leaderboard is not None:
+        print(f'\nbest parameters (of {len(leaderboard)} scored candidates & rounds,',
+              f'see results{args.s_suff}/leaderboard.csv):')
+        print(leaderboard.head().to_string(index=False, float_format='{:.4g}'.format))
     
 
 if __name__ == "__main__":
@@ -6,60 +6,199 @@ Functions pertaining to training and testing.
 Data Science Assignment 3 - Home Depot Search Results
 """
 
+from __future__ import annotations  # unions in type hints on python 3.9
+# python standard library ---------------------------------------------------------------------
+import time                                                             # tuning time budget    |
 # dependencies ---------------------------------------------------------------------------------
+import numpy as np                                                      # arrays                |
 import pandas as pd                                                     # dataframes            |
 from sklearn.ensemble import RandomForestRegressor, BaggingRegressor    # regression models     |
+from sklearn.ensemble import HistGradientBoostingRegressor              # ...                   |
+from threadpoolctl import threadpool_limits                             # boosting threads      |
 from sklearn.model_selection import train_test_split as TTS             # splitting data        |
+from sklearn.model_selection import KFold, ParameterSampler             # tuning                |
+from joblib import Parallel, delayed, effective_n_jobs                  # tuning, threads       |
 from sklearn.metrics import mean_squared_error as MSE                   # measuring performance |
 # local imports --------------------------------------------------------------------------------
-from processing import filter_rare_relevancies, filter_low_similarities     # cleaning data     |
-from plot import plot_feature_importances                                   # plotting features |
+from datamanager import feature_matrix                                  # feature store         |
 # ----------------------------------------------------------------------------------------------
 
-def train_and_test(dataframe: pd.DataFrame) -> float:
-    """Trains and tests a random forest regressor on the given dataframe and returns the root mean squared error"""
-    dataframe = dataframe.copy()
-    dataframe = filter_rare_relevancies(dataframe)
-    for col_name in ['sem_sim_product_title', 'sem_sim_product_description']:
-        filter_low_similarities(dataframe, col_name)
+# in the order of the feature store, so the feature matrix is a view of the memory-mapped store instead of a copy
+RELEVANT_COLUMNS = ['len_of_query',
+                    'sem_sim_product_title', 'sim_sim_product_title', 'tfidf_sim_product_title',
+                    'bm25_sim_product_title', 'tok_sim_product_title',
+                    'sem_sim_product_description', 'sim_sim_product_description', 'tfidf_sim_product_description',
+                    'bm25_sim_product_description', 'tok_sim_product_description']
+FILTERED_COLUMNS = ['sem_sim_product_title', 'sem_sim_product_description']    # low scores are filtered out
 
-    y = dataframe['relevance'].values
-    relevant_columns = ['sim_sim_product_title', 'sim_sim_product_description',
-                        'sem_sim_product_title', 'sem_sim_product_description',
-                        'len_of_query']
-    X = dataframe[relevant_columns].values
+# parameters of the bagged random forest, forest_size is the amount of trees in every bagged forest
+MODEL_PARAMS = {'n_estimators': 45, 'max_samples': 0.1, 'forest_size': 15, 'max_depth': 6,
+                'min_samples_leaf': 1, 'max_features': 1.0}
+# values that are explored by `tune()`, every sampled configuration is a combination of these
+PARAM_SPACE = {'n_estimators': [15, 45, 90], 'max_samples': [0.05, 0.1, 0.25, 0.5], 'forest_size': [5, 15, 30],
+               'max_depth': [4, 6, 8, 12, None], 'min_samples_leaf': [1, 5, 20], 'max_features': [1.0, 0.6]}
 
-    X_train, X_test, y_train, y_test = TTS(X, y, test_size=0.2, random_state=40)
+# parameters of the gradient boosting engine, it stops adding trees once the RMSE on the validation split
+# (a share of the training data) has not improved for n_iter_no_change iterations
+BOOSTING_PARAMS = {'max_iter': 1000, 'learning_rate': 0.05, 'max_leaf_nodes': 31, 'min_samples_leaf': 20,
+                   'l2_regularization': 0.0, 'validation_fraction': 0.1, 'n_iter_no_change': 20}
 
-    RFR = RandomForestRegressor(n_estimators=15, max_depth=6, random_state=0)
-    BR = BaggingRegressor(RFR, n_estimators=45, max_samples=0.1, random_state=25)
-    
-    BR.fit(X_train, y_train)
+def build_model(params: dict = MODEL_PARAMS, n_jobs: int = -1) -> BaggingRegressor:
+    """Creates an (unfitted) bagged random forest regressor with the given parameters (see `MODEL_PARAMS`)"""
+    RFR = RandomForestRegressor(n_estimators=params['forest_size'], max_depth=params['max_depth'],
+                                min_samples_leaf=params['min_samples_leaf'], max_features=params['max_features'],
+                                random_state=0)
+    return BaggingRegressor(RFR, n_estimators=params['n_estimators'], max_samples=params['max_samples'],
+                            random_state=25, n_jobs=n_jobs)
 
-    y_pred = BR.predict(X_test)
-    RMSE = MSE(y_test, y_pred)**0.5
+def build_boosting(params: dict = BOOSTING_PARAMS) -> HistGradientBoostingRegressor:
+    """Creates an (unfitted) histogram-based gradient boosting regressor that stops early (see `BOOSTING_PARAMS`)"""
+    return HistGradientBoostingRegressor(**params, early_stopping=True, scoring='loss', random_state=0)
 
-    return RMSE
+def build_training_data(data: pd.DataFrame | np.ndarray,
+                        keep: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Extracts the data the regression model is trained and tested on, indexing the data only once.
+    ### params
+        - data: pandas `DataFrame` with the relevance, row_id and all relevant feature columns,
+                or the (memory-mapped) feature store itself, which is read without converting it to float64
+        - keep: the output of `filter_mask()`, which entries of the data should be used
 
-def show_feature_importances(dataframe: pd.DataFrame) -> None:
-    """Calls a function that plots the importance of each feature that was used in the regression model"""
-    
-    dataframe = dataframe.copy()
-    dataframe = filter_rare_relevancies(dataframe)
-    for col_name in ['sem_sim_product_title', 'sem_sim_product_description']:
-        filter_low_similarities(dataframe, col_name)
+    ### returns
+        - X: the feature matrix (columns in the order of `RELEVANT_COLUMNS`), float32 if read from the feature store
+        - y: the relevance scores
+        - row_ids: the row ID of every entry in X and y
+    """
+    if isinstance(data, np.ndarray):
+        rows: np.ndarray = np.flatnonzero(keep)
+        return feature_matrix(data, RELEVANT_COLUMNS)[rows], \
+               data['relevance'][rows].astype(np.float64).round(2), data['row_id'][rows].astype(np.int64)
+    data: np.ndarray = data.loc[keep, ['relevance', 'row_id'] + RELEVANT_COLUMNS].to_numpy(np.float64)
+    return data[:,2:], data[:,0], data[:,1].astype(np.int64)
+
+def train_and_test(data: pd.DataFrame | np.ndarray, keep: np.ndarray, n_jobs: int = -1,
+                   engine: str = 'forest') -> tuple[BaggingRegressor | HistGradientBoostingRegressor,
+                                                    dict[str, np.ndarray], float]:
+    """
+    Trains and tests a regression model on the given data.
+    ### params
+        - data: see `build_training_data()`
+        - keep: the output of `filter_mask()`, which entries of the data should be used
+        - n_jobs: the amount of forests that are fitted at the same time, or the amount of threads the gradient
+                  boosting engine uses (-1 means one per core)
+        - engine: 'forest' for a bagged random forest, 'boosting' for histogram-based gradient boosting,
+                  which holds out part of the train set to stop early on
+
+    ### returns
+        - model: the fitted regression model
+        - split: the row IDs of the entries the model was trained ('train') and tested ('test') on
+        - RMSE: the root mean squared error of the model on the test set
+    """
+    X, y, row_ids = build_training_data(data, keep)
+    train, test = TTS(np.arange(len(y)), test_size=0.2, random_state=40)
+
+    if engine == 'forest':
+        model = build_model(MODEL_PARAMS, n_jobs)
+        model.fit(X[train], y[train])
+        y_pred = model.predict(X[test])
+    else:
+        model = build_boosting(BOOSTING_PARAMS)
+        with threadpool_limits(effective_n_jobs(n_jobs), user_api='openmp'):
+            model.fit(X[train], y[train])
+            y_pred = model.predict(X[test])
+    RMSE = MSE(y[test], y_pred)**0.5
 
-    y = dataframe['relevance'].values
-    relevant_columns = ['sim_sim_product_title', 'sim_sim_product_description',
-                        'sem_sim_product_title', 'sem_sim_product_description',
-                        'len_of_query']
-    X = dataframe[relevant_columns].values
+    return model, {'train': row_ids[train], 'test': row_ids[test]}, RMSE
 
-    X_train, _, y_train, _ = TTS(X, y, test_size=0.2, random_state=40)
+def tune(dataframe: pd.DataFrame, keep: np.ndarray, budget: float, n_candidates: int = 27, n_folds: int = 3,
+         n_jobs: int = -1) -> pd.DataFrame:
+    """
+    Searches for better model parameters with cross-validated successive halving: all candidates are first scored
+    on a small part of the training data, after which only the best third is scored again on three times as much data,
+    until a single candidate is left, all training data is used or the time budget runs out.
+    Fits that would start after the time budget has run out are skipped, along with the candidates they belong to.
+    The test set of `train_and_test()` is left out, so its RMSE stays a fair estimate.
+    ### params
+        - dataframe: pandas `DataFrame` with the relevance, row_id and all relevant feature columns
+        - keep: the output of `filter_mask()`, which entries of the dataframe should be used
+        - budget: the amount of seconds after which no new fits are started
+        - n_candidates: the amount of parameter configurations that are sampled from `PARAM_SPACE`
+                        (the current `MODEL_PARAMS` are always one of them)
+        - n_folds: the amount of cross-validation folds every candidate is scored on
+        - n_jobs: the amount of fits that run at the same time (-1 means one per core)
 
-    RFR = RandomForestRegressor(n_estimators=15, max_depth=6, random_state=0)
+    ### returns
+        - leaderboard: every scored candidate and round, with the mean RMSE, its standard deviation
+                       and the mean fit & predict times, best candidates of the last rounds first
+    """
+    X, y, _ = build_training_data(dataframe, keep)
+    train, _ = TTS(np.arange(len(y)), test_size=0.2, random_state=40)
+    X, y = X[train], y[train]
+    order: np.ndarray = np.random.default_rng(0).permutation(len(y))     # every round uses a prefix of this order
+
+    candidates: list[dict] = [MODEL_PARAMS] + [params for params in ParameterSampler(PARAM_SPACE, n_candidates-1,
+                                                                                      random_state=0)
+                                               if params != MODEL_PARAMS]
+    n_rounds: int = int(np.ceil(np.log(len(candidates)) / np.log(3))) + 1
+    n_samples: int = max(len(y) // 3**(n_rounds-1), 10*n_folds)
+
+    results: list[dict] = []
+    deadline: float = time.time() + budget          # wall-clock time, as it is compared to in other processes
+    for rung in range(n_rounds):
+        rows: np.ndarray = order[:min(n_samples, len(y))]
+        folds = list(KFold(n_folds, shuffle=True, random_state=0).split(rows))
+        scores = Parallel(n_jobs=n_jobs)(delayed(_fit_and_score)(params, X[rows], y[rows], fit_rows, score_rows,
+                                                                 deadline)
+                                         for params in candidates for fit_rows, score_rows in folds)
+        
+        round_results: list[dict] = []
+        for i, params in enumerate(candidates):
+            rmse, fit_time, predict_time = np.array(scores[i*n_folds:(i+1)*n_folds]).T
+            if np.isnan(rmse).any():
+                continue                            # not all folds could be scored within the time budget
+            round_results.append({'round': rung, 'n_samples': len(rows)} | params |
+                                 {'rmse': rmse.mean(), 'rmse_std': rmse.std(),
+                                  'fit_time': fit_time.mean(), 'predict_time': predict_time.mean()})
+        results += round_results
+
+        if len(round_results) <= 1 or len(rows) == len(y) or time.time() > deadline:
+            break
+        best: np.ndarray = np.argsort([result['rmse'] for result in round_results])[:max(len(candidates)//3, 1)]
+        candidates = [{param: result[param] for param in PARAM_SPACE} for result in [round_results[i] for i in best]]
+        n_samples *= 3
     
-    RFR.fit(X_train, y_train)
+    if not results:
+        return pd.DataFrame()
+    return pd.DataFrame(results).sort_values(['round', 'rmse'], ascending=[False, True], ignore_index=True)
 
-    plot_feature_importances(relevant_columns, RFR.feature_importances_)
+def _fit_and_score(params: dict, X: np.ndarray, y: np.ndarray, fit_rows: np.ndarray, score_rows: np.ndarray,
+                   deadline: float) -> tuple[float, float, float]:
+    """
+    Fits a single candidate on one cross-validation fold, returns the RMSE, the fit time and the predict time,
+    or NaNs if the deadline has already passed.
+    """
+    if time.time() > deadline:
+        return np.nan, np.nan, np.nan
+    model: BaggingRegressor = build_model(params, n_jobs=1)    # the folds are already spread over all cores
+    fit_start: float = time.perf_counter()
+    model.fit(X[fit_rows], y[fit_rows])
+    predict_start: float = time.perf_counter()
+    y_pred: np.ndarray = model.predict(X[score_rows])
+    predict_end: float = time.perf_counter()
+    return MSE(y[score_rows], y_pred)**0.5, predict_start - fit_start, predict_end - predict_start
+
+def feature_importances(model: BaggingRegressor) -> np.ndarray:
+    """Calculates the importance of each feature as the average over all forests of the fitted model"""
+    importances = np.zeros(model.n_features_in_)
+    for estimator, features in zip(model.estimators_, model.estimators_features_):
+        importances[features] += estimator.feature_importances_
+    return importances / len(model.estimators_)
+
+def show_feature_importances(model: BaggingRegressor, s_suff: str) -> None:
+    """Calls a function that plots the importance of each feature that was used in the regression model"""
+    from plot import plot_feature_importances      # the plotting libraries are only needed here
+    plot_feature_importances(RELEVANT_COLUMNS, feature_importances(model), s_suff)
 
+def predict(model: BaggingRegressor | HistGradientBoostingRegressor, dataframe: pd.DataFrame) -> np.ndarray:
+    """Predicts the relevance of the rows of a dataframe that contains all relevant feature columns"""
+    return model.predict(dataframe[RELEVANT_COLUMNS].values)
@@ -6,52 +6,73 @@ Functions pertaining to plotting results.
 Data Science Assignment 3 - Home Depot Search Results
 """
 
-# python standard library ------------------------------
-from collections import OrderedDict     # trend line    |
+# python standard library ----------------------------------------------
+from collections import OrderedDict                 # trend line        |
 # dependencies -----------------------------------------------------
 import numpy as np                                  # arrays        |
 import pandas as pd                                 # dataframes    |
+import matplotlib                                   # backend       |
 import matplotlib.pyplot as plt                     # plotting      |
 import seaborn as sns                               # plotting      |
 from scipy.interpolate import make_interp_spline    # trend line    |
 from scipy.signal import savgol_filter              # trend line    |
 # local imports ----------------------------------------------------------------------------
 from helper import BOLD, PATH                                           # TUI, directories  |
-from processing import filter_rare_relevancies, filter_low_similarities # filtering data    |
+from processing import filter_mask                                      # filtering data    |
 # ------------------------------------------------------------------------------------------
 
-def plot_distributions(dataframe: pd.DataFrame, metric: str, s_suff: str) -> None:
+def plot_metric(dataframe: pd.DataFrame, metric: str, s_suff: str, sample_size: int = 10_000) -> None:
     """
-    Creates all distribution plots for a given metric (wrapper for `create_area_plot()`).
+    Creates the distribution plots of a single metric (wrapper for `create_area_plot()`),
+    the plots of different metrics are rendered by separate pipeline stages (see stages.py).
     ### params
-        - dataframe: the full pandas `DataFrame` with all data inside
+        - dataframe: pandas `DataFrame` with the relevance and the metric's column
         - metric: the name of the column of which the similarity scores need to be plotted
         - s_suff: lets plot.py know on what dataset the experiment is running
+        - sample_size: the amount of data points the density is estimated on (0 uses all data points)
     """
     global _S
     _S = s_suff
+    matplotlib.use('Agg')                       # render headless, the plots are only saved to disk
+    for job in distribution_jobs(dataframe, metric):
+        render_distribution(*job, sample_size)
 
-    dataframe = dataframe.copy()                    # prevent original dataframe being changed (it is mutable)
-    dataframe = filter_rare_relevancies(dataframe)  # rare relevancies always need to be filtered
-    
+def distribution_jobs(dataframe: pd.DataFrame, metric: str) -> list[tuple[pd.DataFrame, str, bool]]:
+    """Returns the (filtered) data of every distribution plot of a metric, with the metric and whether it was filtered"""
+    jobs: list[tuple[pd.DataFrame, str, bool]] = []
     for filter in [False, True]:
-        if filter:
-            if metric.startswith('sim'):
-                continue                            # simple similarity columns should not be filtered
-            dataframe = filter_low_similarities(dataframe, metric)
-        
-        avg_similarities: OrderedDict = calc_avg_similarities(dataframe, metric)
-        create_area_plot(dataframe, metric, avg_similarities, filter)
+        if filter and not metric.startswith('sem'):
+            continue                            # only semantic similarity columns should be filtered
+        # rare relevancies always need to be filtered
+        keep, _ = filter_mask(dataframe, [metric] if filter else [])
+        jobs.append((dataframe.loc[keep, ['relevance', metric]], metric, filter))
+    return jobs
+
+def render_distribution(dataframe: pd.DataFrame, metric: str, filter: bool, sample_size: int) -> None:
+    """Summarizes the (filtered) data of a metric and creates its distribution plot"""
+    summary: pd.DataFrame = summarize_similarities(dataframe, metric)
+    avg_similarities: OrderedDict = calc_avg_similarities(dataframe, metric, summary)
+    create_area_plot(dataframe, metric, avg_similarities, filter, stratified_sample(dataframe, sample_size))
+
+def stratified_sample(dataframe: pd.DataFrame, sample_size: int) -> pd.DataFrame:
+    """Samples about `sample_size` rows, keeping the share of every relevancy score the same (0 returns all rows)"""
+    if not sample_size or sample_size >= len(dataframe):
+        return dataframe
+    return dataframe.groupby('relevance', group_keys=False).sample(frac=sample_size/len(dataframe), random_state=0)
 
-def create_area_plot(dataframe: pd.DataFrame, metric: str, avg_similarities: dict, filter: bool) -> None:
+def create_area_plot(dataframe: pd.DataFrame, metric: str, avg_similarities: dict, filter: bool,
+                     sample: pd.DataFrame = None) -> None:
     """
     Creates a seaborn `displot` and saves it to disk.
         - dataframe: the full (filtered) pandas `DataFrame` with all data inside
         - metric: the name of the column of which the similarity scores need to be plotted
         - avg_similarities: the average similarities of that column
         - filter: flag that indicates whether the data has been filtered or not
+        - sample: the subset of the data that the density is estimated on, None uses all data
     """
     title: str = metric.replace('sim_sim_', 'Simple Similarity ').replace('sem_sim_', 'Semantic Similarity ')\
+                       .replace('tfidf_sim_', 'TF-IDF Similarity ').replace('bm25_sim_', 'BM25 Score ')\
+                       .replace('tok_sim_', 'Token Similarity ')\
                        .replace('product_title', 'Product Title').replace('product_description', 'Product Description')
     alpha = 0.05 if (_S == '_sample') else 0.006
     
@@ -59,9 +80,10 @@ def create_area_plot(dataframe: pd.DataFrame, metric: str, avg_similarities: dic
     X_Y_Spline = make_interp_spline(rel, savgol_filter(sim, 5, 3))
     X_ = np.linspace(min(rel), max(rel), 500); Y_ = X_Y_Spline(X_)
     
-    area_plot = sns.displot(dataframe, x='relevance', y=metric,
+    area_plot = sns.displot(dataframe if sample is None else sample, x='relevance', y=metric,
                                 kind='kde', fill=True, levels=15, cmap='viridis', thresh=0)
-    area_plot.ax.scatter(dataframe['relevance'], dataframe[metric], color='white', alpha=alpha, label='raw data points')
+    area_plot.ax.scatter(dataframe['relevance'], dataframe[metric], color='white', alpha=alpha, label='raw data points',
+                         rasterized=True)   # a single image instead of a vector element per data point
     area_plot.ax.plot(rel, sim, color='tab:red', label='raw average')
     area_plot.ax.plot(X_, Y_, color='tab:orange', linestyle=':', label='smoothed average')
     area_plot.ax.set_ylabel('similarity score')
@@ -70,38 +92,55 @@ def create_area_plot(dataframe: pd.DataFrame, metric: str, avg_similarities: dic
     area_plot.ax.set_title(title+f_suff)
     f_suff = '_filtered' if filter else ''
     area_plot.fig.savefig(PATH('..',f'results{_S}',f'{metric}_plot{f_suff}.png'), bbox_inches='tight', dpi=300)
+    plt.close(area_plot.fig)
 
-def calc_avg_similarities(dataframe: pd.DataFrame, metric: str) -> OrderedDict:
+def summarize_similarities(dataframe: pd.DataFrame, metric: str) -> pd.DataFrame:
+    """
+    Summarizes the similarity scores of a given metric per relevancy score, in a single grouped aggregation.
+    ### params
+        - dataframe: the full pandas `DataFrame` with all data inside
+        - metric: the name of the column of which the similarity scores need to be summarized
+    
+    ### returns
+        - a `DataFrame` indexed by relevancy score (in increasing order) with the count, mean, std,
+          min, 25%, 50%, 75% and max of the similarity scores
+    """
+    return dataframe.groupby('relevance')[metric].describe().sort_index()
+
+def calc_avg_similarities(dataframe: pd.DataFrame, metric: str, summary: pd.DataFrame = None) -> OrderedDict:
     """
     Calculates the average similarity scores of a given metric.
     ### params
         - dataframe: the full pandas `DataFrame` with all data inside
         - metric: the name of the column of which the similarity scores need to be averaged
+        - summary: the output of `summarize_similarities()`, if it was already calculated
     
     ### returns
         - an ordered dictionary with:
             * keys: relevancy scores (in increasing order)
             * the corresponding averaged similarity scores
     """
-    similarities, occurrences = {}, {}
-    for _, row in dataframe.iterrows():
-        rel, sim = row['relevance'], row[metric]
-        try: similarities[rel] += (sim - similarities[rel])/occurrences[rel]; occurrences[rel] += 1
-        except KeyError: similarities[rel] = sim; occurrences[rel] = 1
-    return OrderedDict(sorted(similarities.items()))
+    if summary is None:
+        summary = summarize_similarities(dataframe, metric)
+    return OrderedDict(summary['mean'].items())
 
-def print_avg_similarities(dataframe: pd.DataFrame, col_name: str) -> None:
-    """Prints data on the average similarity scores of a metric that could also be plotted"""
-    similarities = calc_avg_similarities(dataframe, col_name)
-    print(BOLD(' rel |  sim  '))
-    print(BOLD('-----+-------'))
-    for rel in sorted(similarities.keys()):
-        print(f'{rel:<4} {BOLD("|")} {round(similarities[rel], 3):<5}')
+def print_avg_similarities(dataframe: pd.DataFrame, col_name: str, summary: pd.DataFrame = None) -> None:
+    """Prints data on the similarity scores of a metric that could also be plotted"""
+    if summary is None:
+        summary = summarize_similarities(dataframe, col_name)
+    print(BOLD(' rel |   n   |  sim  |  std  |  25%  |  50%  |  75%  '))
+    print(BOLD('-----+-------+-------+-------+-------+-------+-------'))
+    for rel, row in summary.iterrows():
+        print(f'{rel:<4} {BOLD("|")} {int(row["count"]):<5} {BOLD("|")} {round(row["mean"], 3):<5}',
+              *[f'{BOLD("|")} {round(row[stat], 3):<5}' for stat in ['std', '25%', '50%', '75%']])
 
-def plot_feature_importances(features: list[str], importances: list[float]) -> None:
+def plot_feature_importances(features: list[str], importances: list[float], s_suff: str) -> None:
     """Plots the importance of each feature that was used in the regression model"""
+    global _S
+    _S = s_suff
 
     translate = lambda feature: feature.replace('sim_sim_', 'simple sim. ').replace('sem_sim_', 'semantic sim. ')\
+                .replace('tfidf_sim_', 'TF-IDF sim. ').replace('bm25_sim_', 'BM25 ').replace('tok_sim_', 'token sim. ')\
                 .replace('product_title', 'prod. title').replace('product_description', 'prod. descr.')\
                 .replace('len_of_query', 'query length')
     
@@ -115,3 +154,4 @@ def plot_feature_importances(features: list[str], importances: list[float]) -> N
         label.set_ha('left')
     
     fig.savefig(PATH('..',f'results{_S}','feature_importances.png'), bbox_inches='tight', dpi=300)
+    plt.close(fig)
@@ -6,53 +6,470 @@ Functions pertaining to processing data.
 Data Science Assignment 3 - Home Depot Search Results
 """
 
-# python standard library ----------------------------------
-from functools import lru_cache     # speeding up parsing   |
-# dependencies ---------------------------------------------
-import pandas as pd                 # dataframes            |
-import spacy                        # NLP                   |
-# ----------------------------------------------------------
+from __future__ import annotations  # type hints of lazily imported modules
+# python standard library -------------------------------------------
+from typing import NamedTuple, TYPE_CHECKING    # doc arrays, hints |
+from functools import lru_cache                 # joining lemmas    |
+# dependencies ------------------------------------------------------
+import numpy as np                              # arrays            |
+import pandas as pd                             # dataframes        |
+if TYPE_CHECKING:                               # spaCy is slow to import, so it is imported
+    import spacy                                # by the functions that parse (NLP)
+    from scipy.sparse import csr_matrix         # the same goes for scipy's sparse matrices
+    from datamanager import QueryStore          # (only a type hint, datamanager imports this module)
+# -------------------------------------------------------------------
 
-def parse_data(series: pd.Series, nlp: spacy.Language) -> spacy.tokens.DocBin:
+MODEL = 'en_core_web_lg'            # spaCy model used for parsing
+FEATURES = ('lemma', 'vector')      # token data that is read by the similarity metrics
+FEATURE_VERSION = 1                 # bump whenever a change in this file alters parsed data or scores
+
+TOKEN_BLOCK_MB = 256                # memory cap of a block of rows in the token-level similarity
+BM25_K1 = 1.2                       # how quickly repeated occurrences of a lemma stop adding to the BM25 score
+BM25_B = 0.75                       # how strongly the BM25 score is normalized by the length of the product text
+
+METRICS = ('len', 'sem', 'sim', 'tfidf', 'bm25', 'tok')     # the scores of `compute_features()`, in store order
+
+MIN_SIMILARITY = 0.1                # semantic similarity scores at or below this are unworkably low
+MIN_RELEVANCE_SHARE = 0.001         # relevance scores that occur less often than this are too rare to learn from
+
+# pipeline components needed to produce each kind of token data (vectors are looked up in the vocab)
+FEATURE_COMPONENTS: dict[str, tuple[str, ...]] = {'lemma': ('tok2vec', 'tagger', 'attribute_ruler', 'lemmatizer'),
+                                                  'vector': ()}
+# token attributes that need to be stored in a `DocBin` to preserve each kind of token data
+FEATURE_ATTRS: dict[str, tuple[str, ...]] = {'lemma': ('ORTH', 'LEMMA'),
+                                             'vector': ('ORTH',)}
+
+class DocArrays(NamedTuple):
+    """The token data of a column of spaCy `Doc` objects that the similarity metrics read, as flat NumPy arrays"""
+    vectors: np.ndarray         # float32 doc vectors, one row per doc
+    orths: np.ndarray           # uint64 orth IDs of all tokens, doc after doc
+    lemmas: np.ndarray          # uint64 lemma IDs of all tokens, doc after doc
+    offsets: np.ndarray         # position of every doc's first token in orths & lemmas, plus the total token count
+    strings: dict[int, str]     # lemma ID -> lemma, for all lemmas in the column
+
+    def tokens(self, ids: np.ndarray, doc: int) -> np.ndarray:
+        """Returns the slice of a token ID array (orths or lemmas) that belongs to the given doc"""
+        return ids[self.offsets[doc]:self.offsets[doc+1]]
+
+    def subset(self, docs: np.ndarray) -> 'DocArrays':
+        """Gathers the data of the docs at the given positions into new `DocArrays` (in memory)"""
+        lengths: np.ndarray = self.offsets[docs+1] - self.offsets[docs]
+        offsets = np.append(0, np.cumsum(lengths)).astype(np.int64)
+        tokens = np.repeat(self.offsets[docs] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return DocArrays(np.asarray(self.vectors[docs]), self.orths[tokens], self.lemmas[tokens], offsets, self.strings)
+
+def load_pipeline(model: str, features: tuple[str, ...] = FEATURES, minimal: bool = True) -> spacy.Language:
+    """
+    Loads a spaCy pipeline, by default with only the components that are needed for the given features enabled.
+    ### params
+        - model: name of the spaCy model package to load
+        - features: the kinds of token data (see `FEATURE_COMPONENTS`) that the later stages will read
+        - minimal: if False, the pipeline is loaded with all of its components enabled
+    ### returns
+        - nlp: the spaCy `Language` object used to parse the strings
+    """
+    import spacy
+    nlp: spacy.Language = spacy.load(model)
+    if minimal:
+        nlp.select_pipes(enable=required_components(features, nlp.component_names))
+    return nlp
+
+def required_components(features: tuple[str, ...], available: list[str]) -> list[str]:
+    """Returns the components of a pipeline (in pipeline order) that are needed to produce the given features"""
+    needed = set(component for feature in features for component in FEATURE_COMPONENTS[feature])
+    return [component for component in available if component in needed]
+
+def docbin_attrs(features: tuple[str, ...]) -> list[str]:
+    """Returns the token attributes that a `DocBin` needs to store to preserve the given features"""
+    return sorted(set(attr for feature in features for attr in FEATURE_ATTRS[feature]))
+
+def parse_data(series: pd.Series, nlp: spacy.Language, batch_size: int = 1000, n_process: int = 1,
+               attrs: list[str] = None, cache: QueryStore = None,
+               docbin: bool = True) -> tuple[spacy.tokens.DocBin, DocArrays]:
     """
     In the given pandas `Series`, converts the string values into spaCy `Doc` objects.
     ### params
         - series: a pandas `Series` object containing strings
         - nlp: the spaCy `Language` object used to parse the strings
+        - batch_size: the amount of strings that are buffered and sent through the pipeline at once
+        - n_process: the amount of processes `nlp.pipe` spreads the batches over (-1 means all cores)
+        - attrs: the token attributes to store in the `DocBin` (see `docbin_attrs()`), None stores spaCy's defaults
+        - cache: if not None, the docs are taken from this persistent cache (see `datamanager.QueryStore`),
+                 which only parses the strings it has not seen before with nlp
+        - docbin: if False, no `DocBin` is built (e.g. when only the doc arrays are stored) and None is returned instead
     ### returns
-        - docbin: a spaCy `DocBin` object containing all the parsed string data
+        - docbin: a spaCy `DocBin` object containing all the parsed string data, in the same order as the series
+        - doc_arrays: the vectors and token IDs of the parsed data, in the same order as the series
     """
+    # consecutive duplicates (product title & description of the same product) only need to be parsed once
+    new_run: np.ndarray = series.ne(series.shift()).values
+    strings: np.ndarray = series.values[new_run]
+    run_lengths: np.ndarray = np.diff(np.append(np.flatnonzero(new_run), len(series)))
+
+    from spacy.tokens import DocBin
+    db: DocBin = (DocBin(attrs) if attrs else DocBin()) if docbin else None     # store as spaCy DocBin
+    vectors = np.zeros((len(strings), nlp.vocab.vectors.shape[1]), dtype=np.float32)
+    token_ids: list[np.ndarray] = []
+    docs = (nlp if cache is None else cache).pipe(strings, batch_size=batch_size, n_process=n_process)
+    for i, (doc, run_length) in enumerate(zip(docs, run_lengths)):  # nlp.pipe yields the docs in input order
+        for _ in range(run_length if db is not None else 0):
+            db.add(doc)
+        vectors[i] = doc.vector
+        token_ids.append(doc_token_ids(doc))
+    
+    runs: np.ndarray = np.repeat(np.arange(len(strings)), run_lengths)     # expand the runs again for the arrays
+    return db, build_doc_arrays(vectors[runs], [token_ids[run] for run in runs], nlp)
 
-    @lru_cache(maxsize=1)
-    def _nlp_wrapper(string: str) -> spacy.tokens.Doc:
-        """small wrapper for speed improvement on product title & product description data"""
-        return nlp(string)
+def doc_token_ids(doc: spacy.tokens.Doc) -> np.ndarray:
+    """Returns the (ORTH, LEMMA) ID pair of every token of a doc, as a (tokens x 2) uint64 array"""
+    return doc.to_array(['ORTH', 'LEMMA']).reshape(-1, 2)
 
-    series = series.apply(_nlp_wrapper)
+def build_doc_arrays(vectors: np.ndarray, token_ids: list[np.ndarray], nlp: spacy.Language) -> DocArrays:
+    """
+    Joins the token data of parsed docs into `DocArrays`.
+    ### params
+        - vectors: the doc vector of every doc, as a (docs x width) float32 matrix
+        - token_ids: the (ORTH, LEMMA) ID pairs of every doc (see `doc_token_ids()`), in the same order
+        - nlp: the spaCy `Language` object the docs were parsed with, whose string store holds the lemmas
+    ### returns
+        - the `DocArrays` of the docs, in the same order
+    """
+    ids = np.concatenate(list(token_ids) + [np.zeros((0, 2), dtype=np.uint64)])
+    offsets = np.append(0, np.cumsum([len(doc_ids) for doc_ids in token_ids])).astype(np.int64)
+    lemma_strings = {int(lemma): nlp.vocab.strings[int(lemma)] for lemma in np.unique(ids[:,1])}
+    return DocArrays(vectors, ids[:,0].copy(), ids[:,1].copy(), offsets, lemma_strings)
+
+class TokenVectors(NamedTuple):
+    """The unit vectors of all distinct tokens of a column, by orth ID (tokens without a vector are left at zero)"""
+    orths: np.ndarray           # sorted uint64 orth IDs
+    vectors: np.ndarray         # float32 unit vectors, one row per orth ID
+
+    def lookup(self, orths: np.ndarray) -> np.ndarray:
+        """Returns the rows of the given orth IDs in the table, -1 for orth IDs that are not in it"""
+        rows: np.ndarray = np.minimum(np.searchsorted(self.orths, orths), max(len(self.orths)-1, 0))
+        found: np.ndarray = self.orths[rows] == orths if len(self.orths) else np.zeros(len(rows), dtype=bool)
+        return np.where(found, rows, -1)
+
+def token_vector_table(nlp: spacy.Language, orths: np.ndarray) -> TokenVectors:
+    """Looks up the vectors of the distinct tokens among the given orth IDs in the vocab, and normalizes them"""
+    unique: np.ndarray = np.unique(orths)
+    vectors = np.zeros((len(unique), nlp.vocab.vectors.shape[1]), dtype=np.float32)
+    rows: np.ndarray = np.asarray(nlp.vocab.vectors.find(keys=unique), dtype=np.int64) if len(unique) \
+                       else np.zeros(0, dtype=np.int64)
+    vectors[rows>=0] = np.asarray(nlp.vocab.vectors.data)[rows[rows>=0]]
+    return TokenVectors(unique, normalize(vectors))
+
+def index_products(product_uids: pd.Series) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Maps every row to the unique product it refers to, so product data only has to be parsed and stored once.
+    ### params
+        - product_uids: a pandas `Series` object containing the product_uid of each row
+    ### returns
+        - product_index: for every row, the position of its product among the unique products
+        - first_rows: for every unique product, the position of the first row that refers to it
+    """
+    product_index, _ = pd.factorize(product_uids)   # codes are assigned in order of first appearance
+    _, first_rows = np.unique(product_index, return_index=True)
+    return product_index.astype(np.int64), first_rows
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scales every row of a matrix to unit length, rows without a vector are left at zero"""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms>0)
+
+def calc_semantic_similarity(search_terms: DocArrays, products: DocArrays, product_index: np.ndarray,
+                             block_size: int = 10_000) -> np.ndarray:
+    """
+    Calculates the semantic (cosine) similarity between the search_term and product doc of every row,
+    equal to `search_term.similarity(product)`, but on normalized blocks of the doc vector matrices.
+    ### params
+        - search_terms: the `DocArrays` of the search_term column, one doc per row
+        - products: the `DocArrays` of a product column, one doc per unique product
+        - product_index: for every row, the position of its product in the product column
+        - block_size: the amount of rows that is processed at once, which bounds the memory usage
+    ### returns
+        - the similarity score of every row
+    """
+    similarities = np.zeros(len(product_index), dtype=np.float32)
+    for start in range(0, len(product_index), block_size):
+        rows = slice(start, start+block_size)
+        similarities[rows] = np.einsum('ij,ij->i', normalize(np.asarray(search_terms.vectors[rows])),
+                                                   normalize(products.vectors[product_index[rows]]))
+    # spaCy considers docs with the exact same tokens fully similar, even if they have no vector
+    for row in np.flatnonzero(similarities == 0):
+        if np.array_equal(search_terms.tokens(search_terms.orths, row),
+                          products.tokens(products.orths, product_index[row])):
+            similarities[row] = 1
+    return similarities
+
+def calc_token_similarity(search_terms: DocArrays, products: DocArrays, product_index: np.ndarray,
+                          query_table: TokenVectors, product_table: TokenVectors,
+                          max_memory_mb: float = TOKEN_BLOCK_MB) -> np.ndarray:
+    """
+    Calculates the token-level similarity between the search_term and product doc of every row:
+    for every query token the highest cosine similarity to any of the product's tokens, averaged over the query.
+    Rows are processed in blocks of padded (rows x tokens x vector) matrices, ordered by the amount of product tokens
+    so that little padding is needed, and every block is kept under the memory cap.
+    Tokens without a vector are left out, rows without any query or product token with a vector score 0.
+    ### params
+        - search_terms: the `DocArrays` of the search_term column, one doc per row
+        - products: the `DocArrays` of a product column, one doc per unique product
+        - product_index: for every row, the position of its product in the product column
+        - query_table: the `TokenVectors` of (at least) all search_term tokens
+        - product_table: the `TokenVectors` of (at least) all product tokens
+        - max_memory_mb: the amount of MB the matrices of a single block can take up
+    ### returns
+        - the similarity score of every row
+    """
+    width: int = product_table.vectors.shape[1]
+    has_vector = lambda table: np.append(np.abs(table.vectors).sum(axis=1) > 0, False)  # row -1 has no vector
+
+    # the table rows of every query token & every distinct product token, without the tokens that have no vector
+    query_rows: np.ndarray = query_table.lookup(search_terms.orths)
+    query_docs = np.repeat(np.arange(len(search_terms.offsets)-1), np.diff(search_terms.offsets))
+    query_docs, query_rows = query_docs[has_vector(query_table)[query_rows]], query_rows[has_vector(query_table)[query_rows]]
+    product_rows: np.ndarray = product_table.lookup(products.orths)
+    product_docs = np.repeat(np.arange(len(products.offsets)-1), np.diff(products.offsets))
+    keep: np.ndarray = has_vector(product_table)[product_rows]
+    pairs: np.ndarray = np.unique(np.stack([product_docs[keep], product_rows[keep]], axis=1), axis=0)
+    product_docs, product_rows = pairs[:,0], pairs[:,1]
+
+    query_offsets = np.searchsorted(query_docs, np.arange(len(search_terms.offsets)))
+    product_offsets = np.searchsorted(product_docs, np.arange(len(products.offsets)))
+    query_lengths: np.ndarray = np.diff(query_offsets)[:len(product_index)]
+    product_lengths: np.ndarray = np.diff(product_offsets)[product_index]
+
+    # padding points at an extra zero vector (at the end of every table), padded product tokens are masked out
+    query_vectors = np.vstack([query_table.vectors, np.zeros((1, width), dtype=np.float32)])
+    product_vectors = np.vstack([product_table.vectors, np.zeros((1, width), dtype=np.float32)])
+    query_rows, product_rows = np.append(query_rows, -1), np.append(product_rows, -1)
+    max_query: int = max(int(query_lengths.max(initial=0)), 1)
+    budget: int = int(max_memory_mb * 2**20 / 4)    # float32 elements per block
+
+    similarities = np.zeros(len(product_index), dtype=np.float32)
+    order: np.ndarray = np.argsort(product_lengths, kind='stable')
+    order = order[(product_lengths[order] > 0) & (query_lengths[order] > 0)]
+    start: int = 0
+    while start < len(order):
+        # the widest row of a block is its last one, so the block shrinks until that row fits
+        n_rows: int = len(order) - start
+        while n_rows > 1:
+            per_row: int = (max_query + int(product_lengths[order[start+n_rows-1]])) * width \
+                           + max_query * int(product_lengths[order[start+n_rows-1]])
+            if n_rows * per_row <= budget:
+                break
+            n_rows = max(budget // per_row, 1)
+        rows: np.ndarray = order[start:start+n_rows]
+        query_mask = np.arange(max_query) < query_lengths[rows,None]
+        product_mask = np.arange(product_lengths[rows[-1]]) < product_lengths[rows,None]
+        query_tokens = np.where(query_mask, query_offsets[rows,None] + np.arange(max_query), -1)
+        product_tokens = np.where(product_mask, product_offsets[product_index[rows],None]
+                                                + np.arange(product_mask.shape[1]), -1)
+
+        scores: np.ndarray = np.matmul(query_vectors[query_rows[query_tokens]],
+                                       product_vectors[product_rows[product_tokens]].transpose(0, 2, 1))
+        best: np.ndarray = np.where(product_mask[:,None,:], scores, -np.inf).max(axis=2)
+        similarities[rows] = np.where(query_mask, best, 0).sum(axis=1) / query_lengths[rows]
+        start += n_rows
+    return similarities
+
+def calc_simple_similarity(search_terms: DocArrays, products: DocArrays, product_index: np.ndarray,
+                           substring: bool = False) -> np.ndarray:
+    """
+    Calculates the number of "hits" between the (stemmed) search_term and product doc of every row,
+    i.e. the amount of search_term lemmas that also occur among the product lemmas.
+    ### params
+        - search_terms: the `DocArrays` of the search_term column, one doc per row
+        - products: the `DocArrays` of a product column, one doc per unique product
+        - product_index: for every row, the position of its product in the product column
+        - substring: if True, a lemma also counts as a hit when it occurs anywhere inside the joined product lemmas
+                     (e.g. "screw" in "screwdriver"), which is how the hits were counted originally
+    ### returns
+        - the amount of hits of every row
+    """
+    if substring:
+        return calc_substring_hits(search_terms, products, product_index)
     
-    docbin = spacy.tokens.DocBin(docs=series)       # store as spaCy DocBin
-    return docbin
+    # lemma IDs are hashes, so they are first mapped onto small codes that can be combined with product positions
+    n_query_tokens: int = len(search_terms.lemmas)
+    _, codes = np.unique(np.concatenate([search_terms.lemmas, products.lemmas]), return_inverse=True)
+    n_codes: int = int(codes.max()) + 1 if len(codes) else 1
+
+    # every product's lemma set as sorted (product, lemma) keys
+    product_of_token = np.repeat(np.arange(len(products.offsets)-1), np.diff(products.offsets))
+    product_keys = np.unique(product_of_token * n_codes + codes[n_query_tokens:])
+    
+    # look up every query token in the lemma set of its row's product
+    row_of_token = np.repeat(np.arange(len(product_index)), np.diff(search_terms.offsets))
+    query_keys = product_index[row_of_token] * n_codes + codes[:n_query_tokens]
+    positions = np.minimum(np.searchsorted(product_keys, query_keys), max(len(product_keys)-1, 0))
+    found = product_keys[positions] == query_keys if len(product_keys) else np.zeros(len(query_keys), dtype=bool)
+    return np.bincount(row_of_token, weights=found, minlength=len(product_index)).astype(np.int64)
+
+def calc_substring_hits(search_terms: DocArrays, products: DocArrays, product_index: np.ndarray) -> np.ndarray:
+    """Calculates the number of search_term lemmas of every row that can be found inside the joined product lemmas"""
+
+    @lru_cache(maxsize=1024)
+    def _joined_lemmas(product: int) -> str:
+        """rows of the same product are mostly next to each other, so their lemmas only need to be joined once"""
+        return ' '.join(products.strings[lemma] for lemma in products.tokens(products.lemmas, product).tolist())
+
+    hits = np.zeros(len(product_index), dtype=np.int64)
+    for row, product in enumerate(product_index.tolist()):
+        joined: str = _joined_lemmas(product)
+        hits[row] = sum(int(joined.find(search_terms.strings[lemma])>=0) \
+                        for lemma in search_terms.tokens(search_terms.lemmas, row).tolist())
+    return hits
+
+def term_matrix(doc_arrays: DocArrays, vocabulary: np.ndarray) -> csr_matrix:
+    """
+    Counts how often every lemma of a (sorted) vocabulary of lemma IDs occurs in every doc,
+    as a sparse (docs x vocabulary) matrix, lemmas that are not in the vocabulary are left out.
+    """
+    from scipy.sparse import csr_matrix
+    n_docs: int = len(doc_arrays.offsets) - 1
+    doc_of_token = np.repeat(np.arange(n_docs), np.diff(doc_arrays.offsets))
+    columns: np.ndarray = np.minimum(np.searchsorted(vocabulary, doc_arrays.lemmas), max(len(vocabulary)-1, 0))
+    known: np.ndarray = vocabulary[columns] == doc_arrays.lemmas if len(vocabulary) else np.zeros(len(columns), bool)
+    counts = csr_matrix((np.ones(known.sum(), dtype=np.float32), (doc_of_token[known], columns[known])),
+                        shape=(n_docs, len(vocabulary)))
+    counts.sum_duplicates()     # every lemma that occurs more than once in a doc is added up into a single count
+    return counts
+
+def normalize_rows(matrix: csr_matrix) -> csr_matrix:
+    """Scales every row of a sparse matrix to unit length, empty rows are left at zero"""
+    from scipy.sparse import diags
+    norms: np.ndarray = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    return diags(np.divide(1, norms, out=np.zeros_like(norms), where=norms>0)) @ matrix
+
+class SparseTermIndex:
+
+    def __init__(self, products: DocArrays, k1: float = BM25_K1, b: float = BM25_B) -> None:
+        """
+        Weighs the lemmas of a product column (one doc per unique product) for the TF-IDF and BM25 scores,
+        the vocabulary and document frequencies are taken from the products, so queries can be scored in batches later on.
+        ### params
+            - products: the `DocArrays` of a product column, one doc per unique product
+            - k1: BM25's term frequency saturation (see `BM25_K1`)
+            - b: BM25's document length normalization (see `BM25_B`)
+        """
+        from scipy.sparse import diags
+        self.vocabulary: np.ndarray = np.unique(products.lemmas)
+        counts: csr_matrix = term_matrix(products, self.vocabulary)
+        n_products: int = counts.shape[0]
+        doc_freq: np.ndarray = np.bincount(counts.indices, minlength=len(self.vocabulary))
+
+        # TF-IDF with a smoothed IDF (as scikit-learn's `TfidfVectorizer`), rows are normalized for the cosine
+        self.idf: np.ndarray = (np.log((1 + n_products) / (1 + doc_freq)) + 1).astype(np.float32)
+        self.tfidf: csr_matrix = normalize_rows(counts @ diags(self.idf))
 
-def calc_semantic_similarity(series: pd.Series) -> pd.Series:
-    """Calculates the semantic similarity between two spaCy `Doc` objects"""
-    return series.map(lambda docs: docs[0].similarity(docs[1]))
+        # BM25: IDF times the saturated term frequency, normalized by the length of the product text
+        lengths: np.ndarray = np.diff(products.offsets).astype(np.float32)
+        length_norm: np.ndarray = k1 * (1 - b + b * lengths / max(lengths.mean(), 1))
+        tf: np.ndarray = counts.data
+        self.bm25: csr_matrix = counts.copy()
+        self.bm25.data = (np.log(1 + (n_products - doc_freq + 0.5) / (doc_freq + 0.5))[counts.indices]
+                          * tf * (k1 + 1) / (tf + np.repeat(length_norm, np.diff(counts.indptr)))).astype(np.float32)
 
-def calc_simple_similarity(series: pd.Series) -> pd.Series:
-    """Calculates the number of "hits" between two (stemmed) spaCy `Doc` objects"""
-    return series.map(lambda docs: sum(int(' '.join(token.lemma_ for token in docs[1]).find(word)>=0) \
-                                                    for word in [token.lemma_ for token in docs[0]]))
+    def similarities(self, search_terms: DocArrays, product_index: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Calculates the TF-IDF cosine similarity and the BM25 score between the search_term and product of every row,
+        as row-wise products of sparse matrices.
+        ### params
+            - search_terms: the `DocArrays` of the search_term column, one doc per row
+            - product_index: for every row, the position of its product in the product column
 
-def calc_length(series: pd.Series) -> pd.Series:
+        ### returns
+            - tfidf: the cosine similarity of the TF-IDF vectors of every row
+            - bm25: the BM25 score of every row (every distinct query lemma counts once)
+        """
+        from scipy.sparse import diags
+        counts: csr_matrix = term_matrix(search_terms, self.vocabulary)
+        queries: csr_matrix = normalize_rows(counts @ diags(self.idf))
+        tfidf = np.asarray(queries.multiply(self.tfidf[product_index]).sum(axis=1)).ravel()
+        counts.data[:] = 1
+        bm25 = np.asarray(counts.multiply(self.bm25[product_index]).sum(axis=1)).ravel()
+        return tfidf.astype(np.float32), bm25.astype(np.float32)
+
+def calc_length(search_terms: DocArrays) -> np.ndarray:
     """Calculates the amount of words in an entry, note that a double space does register as a word"""
-    return series.apply(lambda x: len(x))
-
-def filter_low_similarities(dataframe: pd.DataFrame, col_name: str) -> pd.DataFrame:
-    """Filters out entries with unworkably low similarity scores"""
-    dataframe = dataframe[getattr(dataframe, col_name) > 0.1]
-    return dataframe
-
-def filter_rare_relevancies(dataframe: pd.DataFrame) -> pd.DataFrame:
-    """Filters out entries with relevance scores that occur less than 5 times"""
-    rel = dataframe.relevance
-    dataframe = dataframe[(rel != 1.25) & (rel != 1.5) & (rel != 2.5)  & (rel != 2.75)]
-    return dataframe
+    return np.diff(search_terms.offsets)
+
+def compute_features(search_terms: DocArrays, products: dict[str, DocArrays], product_index: np.ndarray,
+                     metrics: tuple[str, ...] = METRICS, substring_hits: bool = False, subset: bool = False,
+                     nlp: spacy.Language = None, tables: dict[str, TokenVectors] = None,
+                     term_indexes: dict[str, SparseTermIndex] = None) -> dict[str, np.ndarray]:
+    """
+    Calculates the scores of every row that the regression model is trained on, in the order of the feature store.
+    ### params
+        - search_terms: the `DocArrays` of the search_term column, one doc per row
+        - products: the `DocArrays` of every product column to score, by column name, one doc per unique product
+        - product_index: for every row, the position of its product in the product columns
+        - metrics: which scores to calculate (see `METRICS`), 'len' is the length of the search terms
+        - substring_hits: count a simple similarity hit whenever a query lemma occurs inside the product text
+        - subset: if True, only the products that the rows refer to are gathered (in memory) before scoring,
+                  which saves work when there are far fewer rows than products
+        - nlp: the spaCy `Language` object whose vocab builds the token vector tables that are not given
+        - tables: the `TokenVectors` of the search_term column and of product columns, by column name
+        - term_indexes: the `SparseTermIndex` of product columns, by column name, which are built from the
+                        products if they are not given (its lemma weights depend on all products, not just a subset)
+    ### returns
+        - the scores by feature name (e.g. 'sem_sim_product_title')
+    """
+    features: dict[str, np.ndarray] = {}
+    if 'len' in metrics:
+        features['len_of_query'] = calc_length(search_terms)
+    positions: np.ndarray = np.unique(product_index) if subset else None
+    local_index: np.ndarray = np.searchsorted(positions, product_index) if subset else product_index
+    tables = dict(tables or {})
+    if 'tok' in metrics and 'search_term' not in tables:
+        tables['search_term'] = token_vector_table(nlp, search_terms.orths)
+
+    for col, all_products in products.items():
+        scored: DocArrays = all_products.subset(positions) if subset else all_products
+        if 'sem' in metrics:
+            features[f'sem_sim_{col}'] = calc_semantic_similarity(search_terms, scored, local_index)
+        if 'sim' in metrics:
+            features[f'sim_sim_{col}'] = calc_simple_similarity(search_terms, scored, local_index,
+                                                                substring=substring_hits)
+        if 'tfidf' in metrics or 'bm25' in metrics:
+            term_index = term_indexes[col] if term_indexes and col in term_indexes else SparseTermIndex(all_products)
+            tfidf, bm25 = term_index.similarities(search_terms, product_index)  # on the positions among all products
+            if 'tfidf' in metrics:
+                features[f'tfidf_sim_{col}'] = tfidf
+            if 'bm25' in metrics:
+                features[f'bm25_sim_{col}'] = bm25
+        if 'tok' in metrics:
+            product_table = tables[col] if col in tables else token_vector_table(nlp, scored.orths)
+            features[f'tok_sim_{col}'] = calc_token_similarity(search_terms, scored, local_index,
+                                                               tables['search_term'], product_table)
+    return features
+
+def filter_mask(dataframe: pd.DataFrame, similarity_cols: list[str] = (), min_similarity: float = MIN_SIMILARITY,
+                min_share: float = MIN_RELEVANCE_SHARE) -> tuple[np.ndarray, dict[str, int]]:
+    """
+    Combines all filtering rules into a single boolean mask, so the data only has to be indexed once.
+    ### params
+        - dataframe: pandas `DataFrame` with a relevance column and the given similarity columns
+        - similarity_cols: the columns of which the entries with unworkably low similarity scores are filtered out
+        - min_similarity: entries with a similarity score at or below this value are filtered out
+        - min_share: entries with a relevance score that makes up less than this share of all entries are filtered out
+    ### returns
+        - keep: for every entry, whether it passes all rules
+        - removed: for every rule (in the order they were applied), the amount of entries it filtered out
+                   that were not already filtered out by an earlier rule
+    """
+    relevance: np.ndarray = dataframe['relevance'].values
+    scores, codes = np.unique(relevance, return_inverse=True)
+    shares: np.ndarray = np.bincount(codes, minlength=len(scores)) / max(len(relevance), 1)
+
+    rules: dict[str, np.ndarray] = {'rare relevance': shares[codes] >= min_share}
+    for col_name in similarity_cols:
+        rules[f'low {col_name}'] = dataframe[col_name].values > min_similarity
+
+    keep = np.ones(len(relevance), dtype=bool)
+    removed: dict[str, int] = {}
+    for rule, passes in rules.items():
+        removed[rule] = int(np.count_nonzero(keep & ~passes))
+        keep &= passes
+    return keep, removed
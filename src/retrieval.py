@@ -0,0 +1,220 @@
+"""
+Retrieval
+===
+Ranks the whole product catalogue for a search query, instead of only scoring the pairs that are present in train.
+---
+Data Science Assignment 3 - Home Depot Search Results
+"""
+
+# python standard library ------------------------------------------------------------------
+import argparse                                             # specifying args from command line |
+import time                                                 # benchmarking                      |
+# dependencies -----------------------------------------------------------------------------
+import numpy as np                                          # arrays                            |
+import pandas as pd                                         # dataframes                        |
+import spacy                                                # natural language processing       |
+# local imports ----------------------------------------------------------------------------
+from helper import BOLD, suppress_W008, fix_dirs            # general utilities                 |
+from datamanager import (input_hash, package_versions,      # data management                   |
+                         artifact_keys, require,            # ...                               |
+                         load_doc_arrays,                   # ...                               |
+                         load_product_uids,                 # ...                               |
+                         PRODUCT_COLUMNS)                   # ...                               |
+from processing import (MODEL, FEATURES, load_pipeline,     # processing data                   |
+                        DocArrays, normalize, parse_data)   # ...                               |
+# ------------------------------------------------------------------------------------------
+
+class ProductIndex:
+
+    def __init__(self, products: DocArrays, product_uids: np.ndarray) -> None:
+        """
+        Builds a retrieval index over the docs of a product column (one doc per unique product):
+        a normalized float32 matrix of the doc vectors, and an inverted index that maps every lemma ID
+        to the (sorted) positions of the products that contain it.
+        """
+        self.vectors: np.ndarray = normalize(np.asarray(products.vectors, dtype=np.float32))
+        self.product_uids = product_uids
+
+        # (lemma, product) pairs, sorted by lemma and then by product, without duplicates
+        product_of_token = np.repeat(np.arange(len(product_uids)), np.diff(products.offsets))
+        order: np.ndarray = np.lexsort((product_of_token, products.lemmas))
+        lemmas, postings = np.asarray(products.lemmas)[order], product_of_token[order]
+        new_pair = np.ones(len(lemmas), dtype=bool)
+        new_pair[1:] = (lemmas[1:] != lemmas[:-1]) | (postings[1:] != postings[:-1])
+        lemmas, self.postings = lemmas[new_pair], postings[new_pair]
+        self.lemmas, starts = np.unique(lemmas, return_index=True)
+        self.starts: np.ndarray = np.append(starts, len(lemmas))
+
+    def __len__(self) -> int:
+        return len(self.product_uids)
+
+    def candidates(self, lemmas: np.ndarray) -> np.ndarray:
+        """Returns the positions of all products that share at least one lemma with the given lemma IDs"""
+        positions: np.ndarray = np.searchsorted(self.lemmas, lemmas)
+        found: np.ndarray = positions < len(self.lemmas)
+        found[found] = self.lemmas[positions[found]] == lemmas[found]
+        return np.unique(np.concatenate([self.postings[self.starts[i]:self.starts[i+1]] for i in positions[found]]
+                                        + [np.zeros(0, dtype=np.int64)]))
+
+    def search(self, queries: DocArrays, k: int = 10, prefilter: bool = False, block_size: int = 20_000,
+               query_block_size: int = 1024) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the k products with the highest cosine similarity to every query doc.
+        ### params
+            - queries: the `DocArrays` of the queries, one doc per query
+            - k: the amount of products that is returned per query
+            - prefilter: if True, only the products that share a lemma with the query are scored
+                         (the same signal `calc_simple_similarity()` counts), which is not exact
+            - block_size: the amount of products that are scored at once, which bounds the memory usage
+            - query_block_size: the amount of queries that are scored at once, which bounds the memory usage
+
+        ### returns
+            - positions: the positions of the top k products of every query, best first (-1 if there are less than k)
+            - scores: the cosine similarities of those products (-inf if there are less than k)
+        """
+        query_vectors: np.ndarray = normalize(np.asarray(queries.vectors, dtype=np.float32))
+        positions = np.full((len(query_vectors), k), -1, dtype=np.int64)
+        scores = np.full((len(query_vectors), k), -np.inf, dtype=np.float32)
+
+        if prefilter:
+            for query in range(len(query_vectors)):
+                candidates: np.ndarray = self.candidates(queries.tokens(queries.lemmas, query))
+                top, top_scores = top_k(self.vectors[candidates] @ query_vectors[query], k)
+                positions[query, :len(top)], scores[query, :len(top)] = candidates[top], top_scores
+            return positions, scores
+
+        for query_start in range(0, len(query_vectors), query_block_size):
+            rows = slice(query_start, query_start+query_block_size)
+            for start in range(0, len(self), block_size):
+                block_scores: np.ndarray = query_vectors[rows] @ self.vectors[start:start+block_size].T
+                # merge the best products so far with the best products of this block
+                merged_scores = np.hstack([scores[rows], block_scores])
+                merged_positions = np.hstack([positions[rows],
+                                              np.broadcast_to(np.arange(start, start+block_scores.shape[1]),
+                                                              block_scores.shape)])
+                best: np.ndarray = np.argpartition(-merged_scores, k-1, axis=1)[:,:k]
+                scores[rows] = np.take_along_axis(merged_scores, best, axis=1)
+                positions[rows] = np.take_along_axis(merged_positions, best, axis=1)
+
+        order: np.ndarray = np.argsort(-scores, axis=1, kind='stable')
+        return np.take_along_axis(positions, order, axis=1), np.take_along_axis(scores, order, axis=1)
+
+def top_k(scores: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the positions and values of the (at most) k highest scores, highest first"""
+    if len(scores) > k:
+        top: np.ndarray = np.argpartition(-scores, k-1)[:k]
+    else:
+        top = np.arange(len(scores))
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return top, scores[top]
+
+def brute_force(index: ProductIndex, queries: DocArrays, k: int = 10) -> tuple[np.ndarray, np.ndarray]:
+    """Finds the top k products of every query by fully sorting the similarities to all products (the reference)"""
+    query_vectors: np.ndarray = normalize(np.asarray(queries.vectors, dtype=np.float32))
+    scores: np.ndarray = query_vectors @ index.vectors.T
+    positions: np.ndarray = np.argsort(-scores, axis=1, kind='stable')[:,:k]
+    return positions, np.take_along_axis(scores, positions, axis=1)
+
+def recall_at_k(found_scores: np.ndarray, reference_scores: np.ndarray) -> float:
+    """
+    The average share of the reference top k of a query that was found, where products that tie with
+    the k-th reference product count as found (equally similar products are interchangeable)
+    """
+    kth: np.ndarray = reference_scores[:,-1:] - 1e-6      # float32 matrix products are not bit-for-bit reproducible
+    return float(np.mean(np.minimum((found_scores >= kth).sum(axis=1), reference_scores.shape[1])
+                         / reference_scores.shape[1]))
+
+def benchmark(index: ProductIndex, queries: DocArrays, k: int = 10) -> pd.DataFrame:
+    """
+    Compares the throughput and recall@k of blocked and prefiltered search to brute force search.
+    ### params
+        - index: the `ProductIndex` that is searched
+        - queries: the `DocArrays` of the queries, one doc per query
+        - k: the amount of products that is retrieved per query
+
+    ### returns
+        - a `DataFrame` with the queries per second and the recall@k of every method
+    """
+    results: list[dict] = []
+    start: float = time.perf_counter()
+    _, reference_scores = brute_force(index, queries, k)
+    results.append({'method': 'brute force', 'queries/sec': len(reference_scores) / (time.perf_counter() - start),
+                    f'recall@{k}': 1.0})
+    for method, prefilter in [('blocked', False), ('prefiltered', True)]:
+        start = time.perf_counter()
+        _, found_scores = index.search(queries, k, prefilter=prefilter)
+        results.append({'method': method, 'queries/sec': len(found_scores) / (time.perf_counter() - start),
+                        f'recall@{k}': recall_at_k(found_scores, reference_scores)})
+    return pd.DataFrame(results)
+
+def argparse_wrapper(parser: argparse.ArgumentParser) -> tuple[str, str, int, list[str], int, bool, bool]:
+    """
+    Returns the parsed arguments of the retrieval script.
+    ### params
+        - the argparse `ArgumentParser` object that was instantiated in retrieval.py
+
+    ### returns
+        - s_suff: determines if the doc arrays of the sample dataset should be used
+        - col: the product column whose doc vectors are searched
+        - k: the amount of products that is retrieved per query
+        - queries: search queries whose top k products are printed
+        - n_benchmark: if not 0, the amount of stored search terms that the search methods are benchmarked on
+        - prefilter: toggles only scoring products that share a lemma with the query
+        - full_pipeline: should match the setting that the stored data was parsed with
+    """
+    parser.add_argument('-f', '--full', action='store_true',
+                        help='search the products of the full dataset, default is to use the sample data')
+    parser.add_argument('--col', choices=PRODUCT_COLUMNS, default='product_title',
+                        help='product column whose doc vectors are searched')
+    parser.add_argument('-k', type=int, default=10,
+                        help='amount of products that is retrieved per query')
+    parser.add_argument('-q', '--query', action='append', default=[],
+                        help='search query whose top k products are printed, can be given multiple times')
+    parser.add_argument('--benchmark', type=int, default=0, metavar='N_QUERIES',
+                        help='benchmark queries/sec and recall@k on this many stored search terms')
+    parser.add_argument('--prefilter', action='store_true',
+                        help='only score the products that share a lemma with the query')
+    parser.add_argument('--full_pipeline', action='store_true',
+                        help='the stored data was parsed with all spaCy pipeline components (see main.py)')
+
+    args = parser.parse_args()
+    s_suff = '' if args.full else '_sample'
+    return s_suff, args.col, args.k, args.query, args.benchmark, args.prefilter, args.full_pipeline
+
+def main():
+
+    s_suff, col, k, queries, n_benchmark, prefilter, full_pipeline = argparse_wrapper(argparse.ArgumentParser())
+    suppress_W008()
+    fix_dirs(s_suff)
+
+    parse_key, _, _ = artifact_keys(input_hash(['train', 'product_descriptions'], s_suff),
+                                    package_versions('spacy', MODEL), full_pipeline, False)
+    for artifact in ['product_uids', col] + (['search_term'] if n_benchmark else []):
+        require(f'parse/{artifact}', parse_key(artifact))
+
+    start: float = time.perf_counter()
+    index = ProductIndex(load_doc_arrays(col), load_product_uids())
+    print(f'indexed {len(index)} products ({len(index.lemmas)} lemmas) in {BOLD(f"{time.perf_counter()-start:.2f}")} s')
+
+    if queries:
+        nlp: spacy.Language = load_pipeline(MODEL, FEATURES, minimal=not full_pipeline)
+        _, query_docs = parse_data(pd.Series(queries, dtype=object), nlp)
+        positions, scores = index.search(query_docs, k, prefilter=prefilter)
+        for query, query_positions, query_scores in zip(queries, positions, scores):
+            print(f'\n{BOLD(query)}')
+            for rank, (position, score) in enumerate(zip(query_positions, query_scores), start=1):
+                if position >= 0:
+                    print(f'{rank:>3}. product {index.product_uids[position]} ({score:.3f})')
+
+    if n_benchmark:
+        search_terms: DocArrays = load_doc_arrays('search_term')
+        sample: np.ndarray = np.random.default_rng(0).choice(len(search_terms.offsets)-1,
+                                                             min(n_benchmark, len(search_terms.offsets)-1),
+                                                             replace=False)
+        print(f'\nbenchmark ({len(sample)} stored search terms, {col}):')
+        print(benchmark(index, search_terms.subset(np.sort(sample)), k).to_string(index=False,
+                                                                                  float_format='{:.4g}'.format))
+
+
+if __name__ == "__main__":
+    main()
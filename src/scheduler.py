@@ -0,0 +1,241 @@
+"""
+Scheduler
+===
+Runs a DAG of named stages concurrently on a process pool, under a memory budget.
+---
+Data Science Assignment 3 - Home Depot Search Results
+"""
+
+# python standard library ----------------------------------------------------------------------
+import os, sys, time                                        # memory size, exiting, timing      |
+import traceback                                            # reporting failed stages           |
+import tracemalloc, cProfile                                # memory tracing, profiling stages  |
+from typing import NamedTuple, Any                          # stages                            |
+from collections.abc import Callable                        # stages                            |
+from concurrent.futures import (ProcessPoolExecutor,        # running stages concurrently       |
+                                Future, wait,               # ...                               |
+                                FIRST_COMPLETED)            # ...                               |
+# local imports --------------------------------------------------------------------------------
+from helper import BOLD, reset_peak_rss, peak_rss           # TUI, measuring memory             |
+# ----------------------------------------------------------------------------------------------
+
+class Stage(NamedTuple):
+    """A named step of the pipeline, with the stored artifacts (see datamanager's manifest) it reads and writes"""
+    name: str                       # e.g. 'parse/search_term', the part before the slash is the stage's group
+    run: Callable                   # top level function (so it can be sent to another process), see `run_stage()`
+    inputs: tuple[str, ...]         # artifacts that need to be up to date before the stage can run
+    outputs: tuple[str, ...]        # artifacts that the stage creates
+    memory: Callable[[], float]     # estimate of the stage's peak memory usage in MB, called once it is ready to run
+    description: str                # what the stage does, for printing the pipeline
+    cached: bool = True             # if False, the stage also runs when all of its outputs are up to date
+    exclusive: bool = False         # if True, no other stage runs at the same time (e.g. because it uses all cores)
+
+class StageResult(NamedTuple):
+    """What a stage function returns to the scheduler"""
+    files: dict[str, list[str]]     # the stored files of every created artifact, relative to the storage folder
+    rows: int = 0                   # the amount of rows the stage processed
+    result: Any = None              # anything else the caller of the scheduler needs (e.g. the RMSE)
+
+def select(stages: list[Stage], only: list[str] = None, start: str = None) -> list[Stage]:
+    """
+    Selects the stages that should be run, in the order they were given (which needs to be a topological order).
+    ### params
+        - stages: all stages of the pipeline
+        - only: names of stages or groups of stages (e.g. 'plot' selects every 'plot/...' stage) to run
+        - start: name of a stage or group of stages that is run together with all stages that depend on it
+
+    ### returns
+        - the selected stages
+    """
+    matches = lambda stage, pattern: stage.name == pattern or stage.name.startswith(pattern+'/')
+    selected: set[str] = set()
+    for pattern in only or []:
+        if not (matching := [stage.name for stage in stages if matches(stage, pattern)]):
+            print(f'\nERROR: There is no stage called {BOLD(pattern)}, choose from:',
+                  ', '.join(stage.name for stage in stages), '\n')
+            sys.exit(1)
+        selected.update(matching)
+
+    if start is not None:
+        if not (downstream := set(stage.name for stage in stages if matches(stage, start))):
+            print(f'\nERROR: There is no stage called {BOLD(start)}, choose from:',
+                  ', '.join(stage.name for stage in stages), '\n')
+            sys.exit(1)
+        produced: set[str] = set(output for stage in stages if stage.name in downstream for output in stage.outputs)
+        for stage in stages:    # stages are in topological order, so a single pass finds all descendants
+            if set(stage.inputs) & produced:
+                downstream.add(stage.name)
+                produced.update(stage.outputs)
+        selected.update(downstream)
+
+    return [stage for stage in stages if stage.name in selected]
+
+def run_stage(name: str, function: Callable, args: tuple, initializer: Callable, initargs: tuple,
+              profile: str = None, trace_memory: bool = False,
+              save_profile: Callable[[cProfile.Profile, str], str] = None) -> tuple[StageResult, dict]:
+    """
+    Runs a stage function in a worker process, and measures its wall time, CPU time and peak RSS.
+    The record has the same fields as the records of the `Timer` (see helper.py), so also the traced memory
+    if `trace_memory` is set, and the location of the stored profile if the name of the stage contains `profile`
+    (which is stored with `save_profile(profiler, name)`).
+    """
+    if initializer is not None:
+        initializer(*initargs)
+    if trace_memory:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()     # worker processes are reused, so tracing keeps running between stages
+        tracemalloc.reset_peak()
+        traced: int = tracemalloc.get_traced_memory()[0]
+    profiler = cProfile.Profile() if profile and profile in name else None
+    reset_peak_rss()
+    cpu: float = time.process_time()
+    tic: float = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    result: StageResult = function(*args)
+    if profiler is not None:
+        profiler.disable()
+    wall_time: float = time.perf_counter() - tic
+    record: dict = {'wall_time': wall_time, 'cpu_time': time.process_time() - cpu,
+                    'rows_per_sec': result.rows / wall_time if wall_time else 0.0, 'peak_rss_mb': peak_rss()}
+    if trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        record |= {'traced_delta_mb': (current - traced) / 2**20, 'traced_peak_mb': peak / 2**20}
+    if profiler is not None:
+        record['profile'] = save_profile(profiler, name)
+    return result, record
+
+def memory_size() -> float:
+    """Returns the amount of physical memory of the machine in MB, or 8 GB if it cannot be determined"""
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except (ValueError, OSError, AttributeError):
+        return 8 * 2**10
+
+class Scheduler:
+
+    def __init__(self, stages: list[Stage], is_valid: Callable[[str], bool], register: Callable[[str, list[str]], None],
+                 n_jobs: int = -1, memory_budget: float = None, initializer: Callable = None,
+                 initargs: tuple = (), profile: str = None, trace_memory: bool = False,
+                 save_profile: Callable[[cProfile.Profile, str], str] = None) -> None:
+        """
+        Sets up a scheduler for the given (selected) stages.
+        ### params
+            - stages: the stages that are to be run, in topological order
+            - is_valid: checks if an up to date version of an artifact is stored
+            - register: registers the stored files of an artifact in the manifest
+            - n_jobs: the amount of stages that can run at the same time, negative amounts count back from the
+                      amount of cores like joblib does (-1 means one per core, -2 one per core but one, at least one)
+            - memory_budget: the amount of MB the running stages can use together (None means 3/4 of the machine's memory)
+            - initializer: function that is called in a worker process before every stage
+            - initargs: arguments of the initializer
+            - profile: stages whose name contains this string are profiled with cProfile
+            - trace_memory: toggles recording the Python memory allocations of every stage with tracemalloc
+            - save_profile: stores the profile of a stage (by stage name) and returns its location,
+                            needs to be picklable (e.g. a `partial` of a top level function)
+        """
+        self.stages = stages
+        self.is_valid = is_valid
+        self.register = register
+        if n_jobs == 0:
+            print(f'\nERROR: The scheduler cannot run {BOLD(0)} stages at the same time.\n')
+            sys.exit(1)
+        self.n_jobs: int = max(os.cpu_count() + 1 + n_jobs, 1) if n_jobs < 0 else n_jobs
+        self.memory_budget: float = memory_budget or 0.75 * memory_size()
+        self.initializer = initializer
+        self.initargs = initargs
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.save_profile = save_profile
+
+    def outdated(self, stage: Stage) -> list[str]:
+        """Returns the outputs of a stage that need to be (re)created"""
+        if not stage.cached:
+            return list(stage.outputs)
+        return [output for output in stage.outputs if not self.is_valid(output)]
+
+    def check_inputs(self) -> None:
+        """Exits if a stage reads an artifact that is neither stored & up to date, nor created by another stage"""
+        produced: set[str] = set(output for stage in self.stages for output in stage.outputs)
+        for stage in self.stages:
+            if missing := [artifact for artifact in stage.inputs if artifact not in produced and not self.is_valid(artifact)]:
+                print(f'\nERROR: Stage {BOLD(stage.name)} needs {", ".join(missing)}, which is missing or outdated.',
+                      f'Please also run the stages that create it (e.g. with --from).\n')
+                sys.exit(1)
+
+    def run(self) -> dict[str, object]:
+        """
+        Runs all stages, a stage is started as soon as all of its inputs are up to date and its memory estimate fits
+        in what is left of the memory budget (a stage that does not fit in the whole budget runs on its own).
+        Exclusive stages always run on their own: once one is ready, no new stages are started until it has finished.
+        Cached stages whose outputs are all up to date are skipped.
+        When a stage fails, no new stages are started, but the outputs of the stages that are still running are stored
+        once they finish, after which the scheduler exits.
+        The record of every stage that ran (in the format of the `Timer`'s records) is kept in `self.records`.
+
+        ### returns
+            - the `result` of every stage that ran, by stage name
+        """
+        self.check_inputs()
+        self.records: list[dict] = []
+        results: dict[str, object] = {}
+        pending: list[Stage] = []
+        print()
+        for stage in self.stages:
+            if not stage.cached or self.outdated(stage):
+                pending.append(stage)
+            else:
+                print(f'  {stage.name} (stored outputs are up to date, skipping)')
+        producers: dict[str, Stage] = {output: stage for stage in pending for output in stage.outputs}
+
+        running: dict[Future, tuple[Stage, float]] = {}
+        failed: list[str] = []
+        with ProcessPoolExecutor(max_workers=max(min(self.n_jobs, len(pending)), 1)) as pool:
+            while (pending and not failed) or running:
+                used: float = sum(memory for _, memory in running.values())
+                busy: list[Stage] = pending + [stage for stage, _ in running.values()]
+                for stage in [] if failed else list(pending):
+                    if len(running) >= self.n_jobs or any(other.exclusive for other, _ in running.values()):
+                        break
+                    if any(producers.get(artifact) in busy for artifact in stage.inputs):
+                        continue    # an input still needs to be created
+                    if stage.exclusive and running:
+                        break       # wait until all running stages have finished
+                    memory: float = stage.memory()
+                    if running and used + memory > self.memory_budget:
+                        continue    # wait until running stages have freed enough memory
+                    future: Future = pool.submit(run_stage, stage.name, stage.run, (self.outdated(stage),),
+                                                 self.initializer, self.initargs, self.profile,
+                                                 self.trace_memory, self.save_profile)
+                    running[future] = (stage, memory)
+                    used += memory
+                    pending.remove(stage)
+                    print(f'  {stage.name} started (estimated {memory:,.0f} MB)')
+
+                if not running:     # stages in topological order never get here, but waiting would never end
+                    print(f'\nERROR: None of the stages {", ".join(stage.name for stage in pending)} can be started.\n')
+                    sys.exit(1)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, _ = running.pop(future)
+                    try:
+                        result, record = future.result()
+                    except (Exception, SystemExit) as e:   # a stage that exits has already reported why
+                        if not isinstance(e, SystemExit):
+                            traceback.print_exception(type(e), e, e.__traceback__)
+                        print(f'  {stage.name} failed')
+                        failed.append(stage.name)
+                        # stages that did not start yet are dropped, the outputs of running stages are still stored
+                        running = {other: running[other] for other in running if not other.cancel()}
+                        continue
+                    for artifact, files in result.files.items():
+                        self.register(artifact, files)
+                    self.records.append({'stage': stage.name, 'rows': result.rows} | record)
+                    results[stage.name] = result.result
+                    print(f'  {stage.name} finished in {BOLD(round(record["wall_time"], 2))} s',
+                          f'(peak RSS {record["peak_rss_mb"]:,.0f} MB)')
+        if failed:
+            print(f'\nERROR: Stage{"s" if len(failed) > 1 else ""} {", ".join(BOLD(name) for name in failed)} failed,',
+                  'the outputs of all stages that finished were stored.\n')
+            sys.exit(1)
+        return results
@@ -0,0 +1,329 @@
+"""
+Service
+===
+Long-lived service that predicts the relevance of (search_term, product_uid) pairs at request time.
+---
+Data Science Assignment 3 - Home Depot Search Results
+"""
+
+from __future__ import annotations  # type hints on python 3.9
+# python standard library ---------------------------------------------------------------------
+import argparse                                             # specifying args from command line |
+import json                                                 # requests & responses              |
+import sys, time                                            # stdin/stdout, batching deadlines  |
+import threading, queue                                     # micro-batching                    |
+from collections import OrderedDict                         # query cache                       |
+from typing import Optional, Union                          # type hints                        |
+from concurrent.futures import Future                       # micro-batching                    |
+from http.server import (BaseHTTPRequestHandler,            # HTTP front end                    |
+                         ThreadingHTTPServer)               # ...                               |
+# dependencies --------------------------------------------------------------------------------
+import numpy as np                                          # arrays                            |
+import pandas as pd                                         # dataframes                        |
+import spacy                                                # natural language processing       |
+# local imports -------------------------------------------------------------------------------
+from helper import BOLD, suppress_W008, fix_dirs, ENGINES   # general utilities, model engines  |
+from datamanager import (input_hash, package_versions,      # data management                   |
+                         artifact_keys, require,            # ...                               |
+                         load_doc_arrays,                   # ...                               |
+                         load_product_uids, load_model,     # ...                               |
+                         PRODUCT_COLUMNS,                   # ...                               |
+                         load_token_vectors, QueryStore)    # ...                               |
+from processing import (MODEL, FEATURES, load_pipeline,     # processing data                   |
+                        DocArrays, SparseTermIndex,         # ...                               |
+                        doc_token_ids, build_doc_arrays,    # ...                               |
+                        compute_features)                   # ...                               |
+from model import predict                                   # regression model                  |
+# ---------------------------------------------------------------------------------------------
+
+class QueryCache:
+
+    def __init__(self, nlp: spacy.Language, size: int = 10_000, store: QueryStore = None) -> None:
+        """
+        Sets up a least recently used cache of parsed search terms,
+        backed by the persistent query cache (if given) that also holds the search terms of earlier runs
+        """
+        self.nlp = nlp
+        self.store = store
+        self.size = size
+        self.queries: OrderedDict[str, tuple[np.ndarray, np.ndarray]] = OrderedDict()     # vector & token IDs
+        self.hits, self.misses = 0, 0
+
+    def parse(self, search_terms: list[str], batch_size: int = 1000) -> DocArrays:
+        """
+        Converts search terms into `DocArrays`, only the search terms that are not in the cache are parsed,
+        all at once (with `nlp.pipe`).
+        ### params
+            - search_terms: the search terms that are to be parsed, duplicates are allowed
+            - batch_size: the amount of strings that are sent through the spaCy pipeline at once
+
+        ### returns
+            - the vectors and token IDs of the search terms, in the same order
+        """
+        parsed: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        for search_term in search_terms:
+            if search_term in self.queries and search_term not in parsed:
+                self.queries.move_to_end(search_term)
+                parsed[search_term] = self.queries[search_term]
+        missing: list[str] = [search_term for search_term in dict.fromkeys(search_terms) if search_term not in parsed]
+        self.hits, self.misses = self.hits + len(search_terms) - len(missing), self.misses + len(missing)
+
+        for search_term, doc in zip(missing, (self.nlp if self.store is None else self.store).pipe(missing, batch_size=batch_size)):
+            parsed[search_term] = self.queries[search_term] = (doc.vector.astype(np.float32), doc_token_ids(doc))
+        while len(self.queries) > self.size:
+            self.queries.popitem(last=False)    # evict the least recently used search term
+
+        vectors, token_ids = zip(*[parsed[search_term] for search_term in search_terms])
+        return build_doc_arrays(np.stack(vectors), token_ids, self.nlp)
+
+class RelevanceScorer:
+
+    def __init__(self, nlp: spacy.Language, substring_hits: bool = False, cache_size: int = 10_000,
+                 batch_size: int = 1000, store: QueryStore = None, engine: str = 'forest') -> None:
+        """
+        Loads the stored product doc arrays and the fitted regression model of the given engine, which are kept in memory,
+        search terms that are not in memory are looked up in the persistent query cache (if given) before parsing
+        """
+        self.products: dict[str, DocArrays] = {col: load_doc_arrays(col) for col in PRODUCT_COLUMNS}
+        self.positions: dict[int, int] = {int(uid): pos for pos, uid in enumerate(load_product_uids())}
+        self.term_indexes = {col: SparseTermIndex(self.products[col]) for col in PRODUCT_COLUMNS}
+        self.token_vectors = {col: load_token_vectors(col) for col in PRODUCT_COLUMNS}
+        self.model, _ = load_model(engine)
+        self.search_terms = QueryCache(nlp, cache_size, store)
+        self.substring_hits = substring_hits
+        self.batch_size = batch_size
+
+    def score(self, pairs: list[tuple[str, int]]) -> list[Optional[float]]:
+        """
+        Predicts the relevance of (search_term, product_uid) pairs, calculating the same scores as the -c stage.
+        ### params
+            - pairs: the search terms and the product_uid of the product they are to be matched with
+
+        ### returns
+            - the predicted relevance of every pair, None if the product is unknown
+        """
+        known: list[int] = [i for i, (_, product_uid) in enumerate(pairs) if product_uid in self.positions]
+        relevance: list[Optional[float]] = [None] * len(pairs)
+        if not known:
+            return relevance
+
+        search_terms: DocArrays = self.search_terms.parse([pairs[i][0] for i in known], self.batch_size)
+        product_index = np.array([self.positions[pairs[i][1]] for i in known], dtype=np.int64)
+        # only the requested products are gathered, the lemma weights of TF-IDF & BM25 still cover all products
+        features = pd.DataFrame(compute_features(search_terms, self.products, product_index,
+                                                 substring_hits=self.substring_hits, subset=True,
+                                                 nlp=self.search_terms.nlp, tables=self.token_vectors,
+                                                 term_indexes=self.term_indexes))
+        for i, predicted in zip(known, predict(self.model, features)):
+            relevance[i] = float(predicted)
+        return relevance
+
+class MicroBatcher:
+
+    def __init__(self, scorer: RelevanceScorer, batch_size: int = 64, max_wait: float = 0.005) -> None:
+        """
+        Collects the pairs of concurrent requests into batches that are scored at once by a single worker thread,
+        a batch is scored as soon as it holds `batch_size` pairs or its first request has waited `max_wait` seconds.
+        """
+        self.scorer = scorer
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.requests: queue.Queue = queue.Queue()     # (pairs, future) of every request
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, pairs: list[tuple[str, int]]) -> Future:
+        """Queues the pairs of a request, the returned `Future` resolves to their predicted relevance"""
+        future = Future()
+        self.requests.put((pairs, future))
+        return future
+
+    def _run(self) -> None:
+        """Scores batches of queued requests, forever"""
+        while True:
+            batch: list[tuple[list[tuple[str, int]], Future]] = [self.requests.get()]
+            deadline: float = time.monotonic() + self.max_wait
+            while sum(len(pairs) for pairs, _ in batch) < self.batch_size:
+                try:
+                    batch.append(self.requests.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            try:
+                relevance = self.scorer.score([pair for pairs, _ in batch for pair in pairs])
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(e)
+                    continue
+                for pairs, future in batch:     # scores the requests one by one, so only the bad requests fail
+                    try:
+                        future.set_result(self.scorer.score(pairs))
+                    except Exception as e:
+                        future.set_exception(e)
+                continue
+            start = 0
+            for pairs, future in batch:
+                future.set_result(relevance[start:start+len(pairs)])
+                start += len(pairs)
+
+def parse_request(payload: Union[dict, list[dict]]) -> list[tuple[str, int]]:
+    """Extracts the (search_term, product_uid) pairs from a request, which is a single JSON object or a list of them"""
+    entries: list[dict] = payload if isinstance(payload, list) else [payload]
+    try:
+        pairs: list[tuple[str, int]] = [(str(entry['search_term']), int(entry['product_uid'])) for entry in entries]
+        for search_term, _ in pairs:
+            search_term.encode('utf-8')     # lone surrogates (e.g. "\ud800") cannot be stored in the query cache
+    except (KeyError, TypeError, ValueError):   # also catches the UnicodeEncodeError
+        raise ValueError('every entry needs a "search_term" (UTF-8 string) and a "product_uid" (integer)')
+    return pairs
+
+def format_response(payload: Union[dict, list[dict]],
+                    relevance: list[Optional[float]]) -> Union[dict, list[dict]]:
+    """Adds the predicted relevance to every entry of a request, None (null) means that the product is unknown"""
+    entries: list[dict] = [dict(entry) | {'relevance': predicted}
+                           for entry, predicted in zip(payload if isinstance(payload, list) else [payload], relevance)]
+    return entries if isinstance(payload, list) else entries[0]
+
+def serve_stdin(batcher: MicroBatcher) -> None:
+    """Reads one JSON request per line from stdin, and writes one JSON response per line to stdout (in order)"""
+    responses: queue.Queue = queue.Queue()     # futures & error responses, None stops the writer
+
+    def _write() -> None:
+        while (response := responses.get()) is not None:
+            print(json.dumps(response.result() if isinstance(response, Future) else response), flush=True)
+
+    def _respond(done: Future, payload: Union[dict, list[dict]], response: Future) -> None:
+        try:
+            response.set_result(format_response(payload, done.result()))
+        except Exception as e:      # scoring failed, the writer still needs a response for this line
+            response.set_result({'error': str(e)})
+
+    writer = threading.Thread(target=_write)
+    writer.start()
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            payload = json.loads(line)
+            future: Future = batcher.submit(parse_request(payload))
+        except ValueError as e:     # also raised for invalid JSON
+            responses.put({'error': str(e)})
+            continue
+        response = Future()
+        future.add_done_callback(lambda done, payload=payload, response=response: _respond(done, payload, response))
+        responses.put(response)
+    responses.put(None)
+    writer.join()
+
+def serve_http(batcher: MicroBatcher, port: int) -> None:
+    """Answers POST requests to /score (JSON body) and GET requests to /health on the given port"""
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _respond(self, status: int, body: Union[dict, list]) -> None:
+            data: bytes = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self) -> None:
+            if self.path != '/health':
+                return self._respond(404, {'error': 'not found'})
+            cache: QueryCache = batcher.scorer.search_terms
+            self._respond(200, {'status': 'ok', 'cached_queries': len(cache.queries),
+                                'cache_hits': cache.hits, 'cache_misses': cache.misses})
+
+        def do_POST(self) -> None:
+            if self.path != '/score':
+                return self._respond(404, {'error': 'not found'})
+            try:
+                payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                pairs: list[tuple[str, int]] = parse_request(payload)
+            except ValueError as e:
+                return self._respond(400, {'error': str(e)})
+            try:
+                relevance: list[Optional[float]] = batcher.submit(pairs).result()
+            except Exception as e:
+                return self._respond(500, {'error': str(e)})
+            self._respond(200, format_response(payload, relevance))
+
+        def log_message(self, *args) -> None:
+            pass    # every request would otherwise be logged to stderr
+
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    print(f'listening on {BOLD(f"http://localhost:{port}")} (POST /score, GET /health)', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+def argparse_wrapper(parser: argparse.ArgumentParser) -> tuple[str, int, int, float, int, bool, bool, bool, str]:
+    """
+    Returns the parsed arguments of the service.
+    ### params
+        - the argparse `ArgumentParser` object that was instantiated in service.py
+
+    ### returns
+        - s_suff: determines if the model & doc arrays of the sample dataset should be used
+        - port: if not 0, the port the HTTP front end listens on, otherwise requests are read from stdin
+        - batch_size: the maximum amount of pairs that are scored at once
+        - max_wait: the maximum amount of seconds a request waits for other requests to be batched with
+        - cache_size: the amount of parsed search terms that are kept in memory
+        - full_pipeline: should match the setting that the stored data was parsed with
+        - substring_hits: should match the setting that the stored scores were calculated with
+        - query_cache: toggles looking up (and adding) parsed search terms in the persistent query cache
+        - engine: the regression model engine whose stored model scores the pairs
+    """
+    parser.add_argument('-f', '--full', action='store_true',
+                        help='use the model trained on the full dataset, default is to use the sample data model')
+    parser.add_argument('--port', type=int, default=0,
+                        help='port to serve HTTP requests on, default (0) reads JSON lines from stdin instead')
+    parser.add_argument('-b', '--batch_size', type=int, default=64,
+                        help='maximum amount of (search_term, product_uid) pairs that are scored at once')
+    parser.add_argument('--max_wait', type=float, default=5,
+                        help='maximum amount of milliseconds a request waits for other requests to be batched with')
+    parser.add_argument('--cache_size', type=int, default=10_000,
+                        help='amount of parsed search terms that are kept in memory')
+    parser.add_argument('--no_query_cache', action='store_true',
+                        help='do not look up search terms in (or add them to) the persistent query cache')
+    parser.add_argument('--full_pipeline', action='store_true',
+                        help='the stored data was parsed with all spaCy pipeline components (see main.py)')
+    parser.add_argument('--substring_hits', action='store_true',
+                        help='the stored scores were calculated with substring hits (see main.py)')
+    parser.add_argument('--engine', default='forest', choices=list(ENGINES),
+                        help='regression model engine whose stored model scores the pairs (see main.py)')
+
+    args = parser.parse_args()
+    s_suff = '' if args.full else '_sample'
+    return s_suff, args.port, args.batch_size, args.max_wait/1000, args.cache_size, args.full_pipeline, \
+           args.substring_hits, not args.no_query_cache, args.engine
+
+def main():
+
+    s_suff, port, batch_size, max_wait, cache_size, full_pipeline, substring_hits, query_cache, engine = \
+        argparse_wrapper(argparse.ArgumentParser())
+    suppress_W008()
+    fix_dirs(s_suff)
+
+    # the service can only be used with a model that was trained on the current data and settings
+    parse_key, _, model_key = artifact_keys(input_hash(['train', 'product_descriptions'], s_suff),
+                                            package_versions('spacy', MODEL), full_pipeline, substring_hits)
+    for col in ['product_uids', *PRODUCT_COLUMNS, *[f'{col}/tokens' for col in PRODUCT_COLUMNS]]:
+        require(f'parse/{col}', parse_key(col))
+    require(f'model/{engine}', model_key(engine))
+
+    nlp: spacy.Language = load_pipeline(MODEL, FEATURES, minimal=not full_pipeline)
+    store: QueryStore = QueryStore(nlp) if query_cache else None
+    batcher = MicroBatcher(RelevanceScorer(nlp, substring_hits, cache_size, store=store, engine=engine), batch_size, max_wait)
+
+    if port:
+        serve_http(batcher, port)
+    else:
+        serve_stdin(batcher)
+    if store is not None:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
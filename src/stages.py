@@ -0,0 +1,194 @@
+"""
+Stages
+===
+The pipeline as a DAG of named stages (see scheduler.py), with the stored artifacts every stage reads and writes.
+---
+Data Science Assignment 3 - Home Depot Search Results
+"""
+
+# python standard library ----------------------------------------------------------------------
+import os, time                                             # file sizes, timing                |
+from functools import partial                               # binding stage arguments           |
+from typing import NamedTuple                               # settings                          |
+# dependencies ---------------------------------------------------------------------------------
+import numpy as np                                          # arrays                            |
+import pandas as pd                                         # dataframes                        |
+# local imports --------------------------------------------------------------------------------
+from helper import PATH, suppress_W008, ENGINES             # directories, warnings, engines    |
+from scheduler import Stage, StageResult                    # stages                            |
+from datamanager import (load_dataframes, load_column,      # data management                   |
+                         create, use_dataset,               # ...                               |
+                         artifact_size, store_as_docbin,    # ...                               |
+                         store_doc_arrays,                  # ...                               |
+                         store_token_vectors,               # ...                               |
+                         load_token_vectors,                # ...                               |
+                         store_product_index,               # ...                               |
+                         store_product_uids,                # ...                               |
+                         load_product_index,                # ...                               |
+                         load_doc_arrays, store_feature,    # ...                               |
+                         load_feature_frame, load_features, # ...                               |
+                         QueryStore, store_model,           # ...                               |
+                         PRODUCT_COLUMNS, METRIC_COLUMNS)   # ...                               |
+from processing import (MODEL, FEATURES, load_pipeline,     # processing data                   |
+                        docbin_attrs, index_products,       # ...                               |
+                        DocArrays, parse_data,              # ...                               |
+                        compute_features,                   # ...                               |
+                        token_vector_table, TOKEN_BLOCK_MB, # ...                               |
+                        calc_length, filter_mask)           # ...                               |
+# ----------------------------------------------------------------------------------------------
+
+GROUPS = ('parse', 'features', 'plot', 'train')    # in the order they depend on each other
+PIPELINE_MB = 1_000         # rough memory usage of the loaded spaCy pipeline
+PARSE_FACTOR = 20           # rough memory usage of parsing a column, relative to the size of its csv file
+PLOT_MB = 300               # rough memory usage of the plotting libraries (or scikit-learn)
+
+class Settings(NamedTuple):
+    """The command line settings the stage functions need, which are sent along to every worker process"""
+    s_suff: str
+    datasets: tuple[str, str]
+    batch_size: int
+    n_process: int
+    full_pipeline: bool
+    substring_hits: bool
+    plot_sample: int
+    n_jobs: int
+    query_cache: bool
+    engines: tuple[str, ...]
+
+def init_worker(s_suff: str) -> None:
+    """Lets a worker process know on what dataset the experiment is running"""
+    use_dataset(s_suff)
+    suppress_W008()
+
+def build_stages(settings: Settings) -> list[Stage]:
+    """Returns all stages of the pipeline, in the order they depend on each other"""
+    csv_mb = lambda dataset: os.path.getsize(PATH('..',f'data{settings.s_suff}',dataset+'.csv')) / 2**20
+    stored_mb = lambda *artifacts: sum(artifact_size(artifact) for artifact in artifacts) / 2**20
+    train, product_descriptions = settings.datasets
+    metrics: list[str] = [metric for metric in METRIC_COLUMNS if metric != 'len_of_query']
+
+    stages: list[Stage] = [Stage('parse/product_index', partial(index_stage, settings), (),
+                                 ('parse/product_index', 'parse/product_uids'), lambda: 4*csv_mb(train),
+                                 f'index the unique products of {train}{settings.s_suff}.csv')]
+    for col in ['search_term', *PRODUCT_COLUMNS]:
+        csv_mbs = lambda col=col: csv_mb(train) + (csv_mb(product_descriptions) if col == 'product_description' else 0)
+        stages.append(Stage(f'parse/{col}', partial(parse_stage, settings, col), (), (f'parse/{col}',),
+                            lambda csv_mbs=csv_mbs: PIPELINE_MB + PARSE_FACTOR*csv_mbs(),
+                            f'parse {col} data into spaCy docs, store the docs and their vectors & token IDs'))
+        stages.append(Stage(f'parse/{col}/tokens', partial(tokens_stage, settings, col), (f'parse/{col}',),
+                            (f'parse/{col}/tokens',), lambda col=col: PIPELINE_MB + 2*stored_mb(f'parse/{col}'),
+                            f'look up the vectors of the distinct tokens of {col} in the vocab and store them'))
+
+    stages.append(Stage('features/len_of_query', partial(length_stage, settings), ('parse/search_term',),
+                        ('calc/len_of_query',), lambda: stored_mb('parse/search_term'),
+                        'calculate the length of search_term'))
+    for col in PRODUCT_COLUMNS:
+        stages.append(Stage(f'features/{col}', partial(score_stage, settings, col),
+                            ('parse/product_index', 'parse/search_term', f'parse/{col}'),
+                            (f'calc/sem_sim_{col}', f'calc/sim_sim_{col}'),
+                            lambda col=col: 1.5*stored_mb('parse/product_index', 'parse/search_term', f'parse/{col}'),
+                            f'calculate semantic & simple similarity scores search_term <-> {col}'))
+        stages.append(Stage(f'features/{col}/sparse', partial(score_stage, settings, col),
+                            ('parse/product_index', 'parse/search_term', f'parse/{col}'),
+                            (f'calc/tfidf_sim_{col}', f'calc/bm25_sim_{col}'),
+                            lambda col=col: 3*stored_mb('parse/product_index', f'parse/{col}')
+                                            + stored_mb('parse/search_term'),
+                            f'calculate TF-IDF & BM25 similarity scores search_term <-> {col} with sparse matrices'))
+        stages.append(Stage(f'features/{col}/tokens', partial(score_stage, settings, col),
+                            ('parse/product_index', 'parse/search_term', f'parse/{col}',
+                             'parse/search_term/tokens', f'parse/{col}/tokens'),
+                            (f'calc/tok_sim_{col}',),
+                            lambda col=col: TOKEN_BLOCK_MB + 2*stored_mb('parse/product_index', f'parse/{col}')
+                                            + stored_mb('parse/search_term'),
+                            f'calculate token-level similarity scores search_term <-> {col}'))
+
+    for metric in metrics:
+        stages.append(Stage(f'plot/{metric}', partial(plot_stage, settings, metric), (f'calc/{metric}',), (),
+                            lambda metric=metric: PLOT_MB + 2*stored_mb(f'calc/{metric}'),
+                            f'plot the distributions of {metric} and save them to disk', cached=False))
+
+    for engine in settings.engines:
+        stages.append(Stage(f'train/{engine}', partial(train_stage, settings, engine),
+                            tuple(f'calc/{metric}' for metric in METRIC_COLUMNS), (f'model/{engine}',),
+                            lambda: PLOT_MB + 4*stored_mb('calc/len_of_query'),
+                            f'train & test a {ENGINES[engine]} on the memory-mapped feature store, store it'
+                            + (' and plot its feature importances' if engine == 'forest' else ''),
+                            cached=False, exclusive=True))  # every engine uses all cores, so their timings compare
+    return stages
+
+def index_stage(settings: Settings, outputs: list[str]) -> StageResult:
+    """Stores the row -> unique product mapping and the product_uid of every unique product"""
+    create('docdata')
+    train: pd.DataFrame = load_dataframes([settings.datasets[0]], settings.s_suff)[0]
+    product_index, first_rows = index_products(train['product_uid'])
+    return StageResult({'parse/product_index': store_product_index(product_index),
+                        'parse/product_uids': store_product_uids(train['product_uid'].values[first_rows])},
+                       rows=len(train))
+
+def parse_stage(settings: Settings, col: str, outputs: list[str]) -> StageResult:
+    """Parses a single column into spaCy docs, and stores the docs and their doc arrays"""
+    create('docbins')
+    create('docdata')
+    s: pd.Series = load_column(settings.datasets, settings.s_suff, col)
+    nlp = load_pipeline(MODEL, FEATURES, minimal=not settings.full_pipeline)
+    attrs = None if settings.full_pipeline else docbin_attrs(FEATURES)
+    # search terms repeat across runs and datasets, so they are taken from the persistent query cache
+    cache = QueryStore(nlp) if col == 'search_term' and settings.query_cache else None
+    db, doc_arrays = parse_data(s, nlp, settings.batch_size, settings.n_process, attrs, cache)
+    files: list[str] = store_as_docbin(db, col, nlp.pipe_names) \
+                       + store_doc_arrays(doc_arrays, col, nlp.pipe_names, nlp.component_names)
+    if cache is not None:
+        cache.close()
+    return StageResult({f'parse/{col}': files}, rows=len(s), result=None if cache is None else cache.stats())
+
+def tokens_stage(settings: Settings, col: str, outputs: list[str]) -> StageResult:
+    """Stores the token vector table of a parsed column, which only needs the vocab of the pipeline (no parsing)"""
+    doc_arrays: DocArrays = load_doc_arrays(col)
+    nlp = load_pipeline(MODEL, FEATURES, minimal=not settings.full_pipeline)
+    return StageResult({f'parse/{col}/tokens': store_token_vectors(token_vector_table(nlp, doc_arrays.orths), col)},
+                       rows=len(doc_arrays.offsets) - 1)
+
+def length_stage(settings: Settings, outputs: list[str]) -> StageResult:
+    """Calculates the length of every search term and stores it in the feature store"""
+    lengths = calc_length(load_doc_arrays('search_term'))
+    return StageResult({'calc/len_of_query': store_feature(lengths, 'len_of_query')}, rows=len(lengths))
+
+def score_stage(settings: Settings, col: str, outputs: list[str]) -> StageResult:
+    """Calculates the outdated similarity scores (outputs) between the search terms and a product column"""
+    product_index = load_product_index()
+    metrics: tuple[str, ...] = tuple(output.split('/')[1].split('_')[0] for output in outputs)
+    tables = {name: load_token_vectors(name) for name in ['search_term', col]} if 'tok' in metrics else None
+    scores = compute_features(load_doc_arrays('search_term'), {col: load_doc_arrays(col)}, product_index, metrics,
+                              settings.substring_hits, tables=tables)
+    return StageResult({f'calc/{name}': store_feature(values, name) for name, values in scores.items()},
+                       rows=len(product_index))
+
+def plot_stage(settings: Settings, metric: str, outputs: list[str]) -> StageResult:
+    """Creates the distribution plots of a single metric"""
+    from plot import plot_metric    # the plotting libraries are only needed here
+    dataframe: pd.DataFrame = load_feature_frame([metric])
+    plot_metric(dataframe, metric, settings.s_suff, settings.plot_sample)
+    return StageResult({}, rows=len(dataframe))
+
+def train_stage(settings: Settings, engine: str, outputs: list[str]) -> StageResult:
+    """
+    Trains and tests a regression model engine (see model.py) on the filtered feature store and stores it.
+    The features are read straight from the memory-mapped store as float32, only the filtering columns are loaded
+    into a dataframe. The result holds the engine, its RMSE and training time, the amount of entries every filtering
+    rule removed and the amount of entries.
+    """
+    from model import train_and_test, show_feature_importances, FILTERED_COLUMNS   # scikit-learn is slow to import
+    keep, removed = filter_mask(load_feature_frame(FILTERED_COLUMNS), FILTERED_COLUMNS)
+    features: np.ndarray = load_features()
+    tic: float = time.perf_counter()
+    model, split, RMSE = train_and_test(features, keep, settings.n_jobs, engine)
+    train_time: float = time.perf_counter() - tic
+    files: list[str] = store_model(model, split, engine)
+    if engine == 'forest':
+        show_feature_importances(model, settings.s_suff)
+        # the idle processes joblib fitted with would otherwise keep this worker process from exiting for minutes
+        from joblib.externals.loky import get_reusable_executor
+        get_reusable_executor().shutdown(wait=True)
+    return StageResult({f'model/{engine}': files}, rows=int(keep.sum()),
+                       result={'engine': engine, 'RMSE': RMSE, 'train_time': train_time,
+                               'removed': removed, 'n_rows': len(features)})